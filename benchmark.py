@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# Benchmarks for the overhead of microcli itself.
+# Each command exits with a non-zero status if the measured
+# value exceeds its budget, so they can be used in CI, eg:
+# python benchmark.py import_time --budget-ms 30
+
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+
+from microcli import MicroCLI, command, timer
+
+SOURCE_DIR = os.path.dirname(os.path.abspath(__file__))
+IMPORT_TIMER = (
+    "import sys, time; timer = getattr(time, 'perf_counter', time.time); "
+    "t = timer(); import microcli; sys.stdout.write(repr(timer() - t))")
+
+OPTION_DEFAULTS = [1, "a", True, 1.5, False]
+
+# shapes of the commands of the classes generated by the suite command:
+# name -> make_cli_class kwargs
+SUITE_SHAPES = {
+    'plain': {'kwarg_count': 0},
+    'kwargs': {'kwarg_count': 5},
+    'varargs': {'kwarg_count': 2, 'varargs': True},
+}
+# each sample of a measurement runs for at least this long (seconds),
+# sub-millisecond operations are repeated as many times as needed
+MIN_SAMPLE_TIME = 0.05
+# differences with the baseline smaller than these are never regressions,
+# by unit (the suffix of the measurement names)
+MIN_DIFFERENCES = {'ms': 1.0, 'us': 50.0, 'kb': 256.0}
+# cases with regressions are measured again up to this many times, and
+# only reported if the best measurements of all the runs still regress
+REMEASURE_COUNT = 3
+
+
+class NullStream(object):
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def make_cli_class(command_count=1, kwarg_count=0, varargs=False,
+                   **attributes):
+    """ Returns a new MicroCLI subclass with the given number of commands,
+        each taking a positional arg, kwarg_count kwargs of various
+        types and optionally varargs. """
+    namespace = {'command': command}
+    for cmd_ix in range(command_count):
+        params = ["self", "arg"] + [
+            "option%d=%r" % (i, OPTION_DEFAULTS[i % len(OPTION_DEFAULTS)])
+            for i in range(kwarg_count)]
+        if varargs:
+            params.append("*rest")
+        exec("@command()\ndef command%d(%s):\n    return None\n" % (
+            cmd_ix, ", ".join(params)), namespace)
+        attributes["command%d" % cmd_ix] = namespace["command%d" % cmd_ix]
+    return type("SyntheticCLI", (MicroCLI,), attributes)
+
+
+def option_args(kwarg_count):
+    """ Command line setting each option of a make_cli_class command """
+    args = []
+    for i in range(kwarg_count):
+        default = OPTION_DEFAULTS[i % len(OPTION_DEFAULTS)]
+        args.append("--option%d" % i)
+        if type(default) != bool:
+            args.append(str(default))
+    return args
+
+
+def best_time(fun, number=1, repeat=5):
+    """ Best wall clock time of number calls to fun, in seconds """
+    timings = []
+    for _ in range(repeat):
+        start = timer()
+        for _ in range(number):
+            fun()
+        timings.append(timer() - start)
+    return min(timings)
+
+
+def calibrate_number(fun, min_time=MIN_SAMPLE_TIME):
+    """ Number of calls to fun taking at least min_time seconds """
+    start = timer()
+    fun()
+    elapsed = timer() - start
+    return max(1, int(min_time / max(elapsed, 1e-9)) + 1)
+
+
+def best_time_per_call(fun, repeat=5):
+    """ Best time of a call to fun in seconds, from samples of
+        at least MIN_SAMPLE_TIME seconds """
+    number = calibrate_number(fun)
+    return best_time(fun, number, repeat) / number
+
+
+def reference_workload():
+    """ Pure python work of a fixed size. The suite stores its time with
+        the results, so that runs on machines (or states of a machine)
+        of different speeds can be compared """
+    values = {}
+    for i in range(20000):
+        values[str(i)] = i
+    sorted(values, key=values.get)
+
+
+def peak_memory_kb(fun):
+    """ Peak memory allocated while calling fun, None before python 3.4 """
+    try:
+        import tracemalloc
+    except ImportError:
+        return None
+    tracemalloc.start()
+    try:
+        fun()
+        return tracemalloc.get_traced_memory()[1] / 1024.0
+    finally:
+        tracemalloc.stop()
+
+
+def measure_suite_case(command_count, shape, repeat):
+    """ Measures a class with command_count commands of the given shape:
+        introspecting its commands, rendering the full help, running a
+        command through MicroCLI.run, and the peak memory of the first
+        two. Times are the best of repeat runs. """
+    kwarg_count = SUITE_SHAPES[shape]['kwarg_count']
+    cli_class = make_cli_class(
+        command_count, exit=classmethod(lambda cls, code: None),
+        **SUITE_SHAPES[shape])
+    null = NullStream()
+
+    def introspect():
+        cli_class.clear_command_specs()
+        return cli_class(["benchmark"], null)
+
+    def render_help(cli):
+        cli.global_optparser.print_help(null)
+
+    def introspect_and_render_help():
+        render_help(introspect())
+
+    def time_help():
+        # parsers and the listing are built lazily, so
+        # each run renders with new ones
+        cli = introspect()
+        start = timer()
+        render_help(cli)
+        return timer() - start
+
+    help_number = calibrate_number(introspect_and_render_help)
+    help_time = min(
+        sum(time_help() for _ in range(help_number))
+        for _ in range(repeat)) / help_number
+    argv = ["benchmark", "command0"] + option_args(kwarg_count) + ["x"]
+    return {
+        # measured with the case, as the speed of the machine varies
+        'reference_ms': best_time_per_call(reference_workload, repeat) * 1e3,
+        'introspection_ms': best_time_per_call(introspect, repeat) * 1e3,
+        'help_ms': help_time * 1e3,
+        'dispatch_us': best_time_per_call(
+            lambda: cli_class(argv, null).run(), repeat) * 1e6,
+        'peak_memory_kb': peak_memory_kb(introspect_and_render_help),
+    }
+
+
+def merge_best(measurements, other_measurements):
+    """ Returns the lowest of each measurement of two runs of a case """
+    merged = dict(measurements)
+    for name, value in other_measurements.items():
+        if merged.get(name) is None or (
+                value is not None and value < merged[name]):
+            merged[name] = value
+    return merged
+
+
+def get_median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def get_timing_noise(results):
+    """ Relative spread of the reference_ms of the cases of results: how
+        much the speed of the machine varied during the run """
+    references = [measurements['reference_ms']
+                  for measurements in results.values()]
+    return max(references) / min(references) - 1
+
+
+def compare_results(results, baseline, threshold):
+    """ Returns (case, description) for each measurement of results
+        which exceeds its value in baseline by more than threshold (a
+        ratio), or the timing noise of results if that is larger, and
+        by more than the MIN_DIFFERENCES of its unit. Baseline times are
+        scaled by the ratio of the median reference_ms of the cases (the
+        time of reference_workload measured with each of them) in results
+        and in baseline: the reference of a single case varies too much
+        between runs. """
+    shared_cases = [case for case in results
+                    if baseline.get(case, {}).get('reference_ms')]
+    speed_ratio = 1.0
+    if shared_cases:
+        speed_ratio = (
+            get_median(results[case]['reference_ms']
+                       for case in shared_cases) /
+            get_median(baseline[case]['reference_ms']
+                       for case in shared_cases))
+    regressions = []
+    for case, measurements in sorted(results.items()):
+        baseline_measurements = baseline.get(case, {})
+        for name, value in sorted(measurements.items()):
+            baseline_value = baseline_measurements.get(name)
+            if value is None or not baseline_value or name == 'reference_ms':
+                continue
+            unit = name.rsplit("_", 1)[-1]
+            tolerance = threshold
+            if unit in ("ms", "us"):
+                baseline_value *= speed_ratio
+                tolerance = max(threshold, get_timing_noise(results))
+            if value > baseline_value * (1 + tolerance) and \
+                    value - baseline_value > MIN_DIFFERENCES.get(unit, 0):
+                regressions.append((
+                    case, "%s %s: %.1f, baseline %.1f (+%.0f%%)" % (
+                        case, name, value, baseline_value,
+                        (value / baseline_value - 1) * 100)))
+    return regressions
+
+
+class Benchmark(MicroCLI):
+
+    def _import_time_us(self):
+        # -X importtime only reports modules which weren't already
+        # imported by the interpreter on startup.
+        if sys.version_info >= (3, 7):
+            process = subprocess.Popen(
+                [sys.executable, "-X", "importtime", "-c", "import microcli"],
+                cwd=SOURCE_DIR,
+                stderr=subprocess.PIPE)
+            _, stderr = process.communicate()
+            match = re.search(
+                br"\|\s*(\d+)\s*\|\s*microcli\s*$", stderr, re.MULTILINE)
+            return int(match.group(1))
+        output = subprocess.check_output(
+            [sys.executable, "-c", IMPORT_TIMER], cwd=SOURCE_DIR)
+        return int(float(output) * 1e6)
+
+    @command()
+    def import_time(self, budget_ms=30.0, repeat=5):
+        """Measures 'import microcli' in fresh interpreters
+           (best of --repeat runs)."""
+        best_ms = min(self._import_time_us() for _ in range(repeat)) / 1000.0
+        self.write("import microcli: %.2f ms (budget: %.2f ms)" % (
+            best_ms, budget_ms))
+        if best_ms > budget_ms:
+            self.write("Over budget!")
+            return 1
+        return 0
+
+    @command()
+    def parser(self, kwargs=20, positional=100, number=200):
+        """Compares the optparse and native option parser engines
+           on a command with --kwargs options."""
+        args = option_args(kwargs) + ["x"] * positional
+        results = []
+        for native in (False, True):
+            cli_class = make_cli_class(
+                kwarg_count=kwargs, native_option_parser=native)
+
+            def cold():
+                cli = cli_class(["benchmark"] + args)
+                cli.parse_command_args(
+                    cli.command_definitions["command0"], args)
+
+            cli = cli_class(["benchmark"] + args)
+            command_def = cli.command_definitions["command0"]
+            warm = best_time(
+                lambda: cli.parse_command_args(command_def, args), number)
+            results.append((best_time(cold, number), warm))
+            self.write("%-8s cold: %8.1f us  warm: %8.1f us" % (
+                "native" if native else "optparse",
+                results[-1][0] / number * 1e6,
+                results[-1][1] / number * 1e6))
+        self.write("speedup  cold: %8.1fx    warm: %8.1fx" % (
+            results[0][0] / results[1][0], results[0][1] / results[1][1]))
+        return 0
+
+    @command()
+    def varargs(self, min_exponent=3, max_exponent=6, native=False):
+        """Dispatch time of a command with args, kwargs and
+           10^min_exponent to 10^max_exponent varargs."""
+        cli_class = make_cli_class(
+            kwarg_count=2, varargs=True, native_option_parser=native)
+        cli = cli_class(["benchmark"])
+        command_def = cli.command_definitions["command0"]
+        for exponent in range(min_exponent, max_exponent + 1):
+            args = option_args(2) + ["x"] * 10 ** exponent
+            elapsed = best_time(lambda: command_def.run(cli, args), repeat=3)
+            self.write("10^%d args: %9.2f ms  %6.3f us/arg" % (
+                exponent, elapsed * 1e3, elapsed * 1e6 / len(args)))
+        return 0
+
+    @command()
+    def suite(self, counts="10,100,1000,10000", shapes="plain,kwargs,varargs",
+              repeat=5, output="", baseline="", threshold=0.25):
+        """Measures introspection, help rendering, dispatch and peak
+           memory of generated classes with --counts commands of each
+           of --shapes. Results are written as JSON to --output, and
+           compared with those of an earlier run in --baseline: exits
+           with 1 if any measurement is more than --threshold (a ratio)
+           above its baseline, or above the timing noise of the run (the
+           spread of the reference times of its cases) if that is larger.
+           Cases with regressions are measured again first, and only fail
+           if the regression reproduces."""
+        cases = {}
+        results = {}
+        for command_count in [int(count) for count in counts.split(",")]:
+            for shape in shapes.split(","):
+                case = "%d/%s" % (command_count, shape)
+                cases[case] = (command_count, shape)
+                results[case] = measure_suite_case(
+                    command_count, shape, repeat)
+                self.write(
+                    "%-12s introspection: %9.2f ms  help: %9.2f ms  "
+                    "dispatch: %9.1f us  peak memory: %s" % (
+                        case, results[case]['introspection_ms'],
+                        results[case]['help_ms'],
+                        results[case]['dispatch_us'],
+                        "%.0f KiB" % results[case]['peak_memory_kb']
+                        if results[case]['peak_memory_kb'] is not None
+                        else "n/a"))
+        regressions = []
+        if baseline:
+            with open(baseline) as baseline_file:
+                baseline_results = json.load(baseline_file)['results']
+            regressions = compare_results(results, baseline_results, threshold)
+            for _ in range(REMEASURE_COUNT):
+                if not regressions:
+                    break
+                # a slow run (eg. the machine was busy) is only a
+                # regression if the best of a few runs is slow too
+                for case in sorted(set(case for case, _ in regressions)):
+                    self.write("Measuring %s again" % case)
+                    results[case] = merge_best(
+                        results[case], measure_suite_case(
+                            *(cases[case] + (repeat,))))
+                regressions = compare_results(
+                    results, baseline_results, threshold)
+        if output:
+            with open(output, "w") as output_file:
+                json.dump({
+                    'python': platform.python_version(),
+                    'results': results,
+                }, output_file, indent=2, sort_keys=True)
+        if baseline and get_timing_noise(results) > threshold:
+            self.write("Timing noise: %.0f%%, smaller regressions are not "
+                       "reported" % (get_timing_noise(results) * 100))
+        for _, regression in regressions:
+            self.write("Regression: %s" % regression)
+        return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    Benchmark.main()
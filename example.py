@@ -4,6 +4,10 @@ from math import log
 
 class Calculator(MicroCLI):
 
+    # run without arguments and with CALCULATOR_SERVE set to a socket
+    # path, the calculator serves requests (see README.md)
+    serve_env_var = "CALCULATOR_SERVE"
+
     def __init__(self, *args, **kwargs):
         super(Calculator, self).__init__(*args, **kwargs)
         # register global option
@@ -13,6 +17,10 @@ class Calculator(MicroCLI):
             default=False,
             dest='output_hex',
             help='Print result in hexadecimal')
+        # register --output-format (jsonl, csv, tsv or binary)
+        self.global_optparser.add_output_format_option(self.output_encoders)
+        # register --timings
+        self.global_optparser.add_timings_option()
 
     # not all functions are commands, only those
     # decorated with @command()
@@ -23,12 +31,15 @@ class Calculator(MicroCLI):
             template = "%s"
         return template % result
 
-    @command()
+    # With stream_varargs, numbers can also be read from a file
+    # (@numbers.txt) or from stdin (-), one per line.
+    # arg_types converts them (on python 3, *number: int does the same)
+    @command(stream_varargs=True, arg_types={'number': int})
     def add(self, *number):
         """Adds all parameters interpreted as integers"""
-        return self._format_result(sum(
-            # positional arguments are always strings
-            [int(n) for n in number]))
+        # number holds a single array of all the arguments
+        numbers, = number
+        return self._format_result(sum(numbers))
 
     @command()
     def subtract(self, number1, number2):
@@ -1,20 +1,73 @@
 #!/usr/bin/env python
 
-# To run a single test, run eg:
-# python microcli.py MicroCLITestCase.test_varargs
-
-from optparse import (OptionParser, BadOptionError,
+# Keep the imports here light, they are paid for by every invocation
+# of every CLI. Modules needed only by some code paths (eg. inspect,
+# traceback) are imported where they are used.
+from optparse import (OptionParser, BadOptionError, Values,
                       AmbiguousOptionError, IndentedHelpFormatter)
-import inspect
+import errno
+from functools import partial, wraps
+from itertools import chain, islice
+import marshal
+import os
 import sys
-from functools import wraps
+import time
 import types
-import unittest
+
+# high resolution clock of the phase timings (python 2 has no perf_counter)
+timer = getattr(time, 'perf_counter', time.time)
+# The start of the 'import' phase: the rest of the import of microcli and
+# everything the tool's module does until it calls MicroCLI.main.
+IMPORT_STARTED = timer()
 
 COMMAND_ATTR = "_command"
+COMMAND_SPECS_ATTR = "_command_specs"
+# option objects shared by the command parsers of a class
+SHARED_OPTIONS_ATTR = "_shared_options"
+COMMAND_INDEX_ATTR = "_command_index"
+LAZY_COMMANDS_ATTR = "_lazy_commands"
+HELP_CACHE_ATTR = "_help_cache"
 GLOBAL_OPTIONS_STR = "[global options]"
 COMMAND_OPTIONS_STR = "[command options]"
 ARG_NO_DEFAULT_VALUE = object()
+STDIN_ARG = "-"
+RESPONSE_FILE_PREFIX = "@"
+# response files at least this large are read through mmap
+RESPONSE_FILE_MMAP_SIZE = 1 << 20
+# sends metrics of invocations to this target if it is set, see
+# MicroCLI.metrics_target
+METRICS_ENV_VAR = "MICROCLI_METRICS"
+# phases of an invocation timed by MicroCLI.record_timing, in order
+TIMING_PHASES = (
+    "import", "introspection", "global_options", "parse", "execute", "output")
+# Shell hooks printed by the 'completion' command, which call
+# microcli_complete.py for the candidates
+COMPLETION_HOOKS = {
+    'bash': """_microcli_%(name)s() {
+    local IFS=$'\\n'
+    COMPREPLY=($(%(helper)s "$COMP_CWORD" "${COMP_WORDS[@]}"))
+}
+complete -o default -F _microcli_%(name)s %(program)s""",
+    'zsh': """_microcli_%(name)s() {
+    local -a candidates
+    candidates=(${(f)"$(%(helper)s $((CURRENT - 1)) "${words[@]}")"})
+    if (( ${#candidates} )); then
+        compadd -a candidates
+    else
+        _files
+    fi
+}
+compdef _microcli_%(name)s %(program)s""",
+    'fish': """function __microcli_%(name)s
+    set -l words (commandline -opc)
+    %(helper)s (count $words) $words (commandline -ct)
+end
+complete -c %(program)s -a '(__microcli_%(name)s)'""",
+}
+# separates the commands of the 'pipe' command
+PIPELINE_SEPARATOR = "then"
+# exit status of a process killed by SIGPIPE
+EXIT_STATUS_BROKEN_PIPE = 128 + 13
 
 
 class CustomStderrOptionParser(OptionParser):
@@ -24,21 +77,25 @@ class CustomStderrOptionParser(OptionParser):
             stderr=sys.stderr,
             exit=sys.exit,
             ignore_unknown=False,
+            interspersed_args=True,
             **kwargs):
         OptionParser.__init__(self, **kwargs)
+        # with interspersed_args=False, everything after the first
+        # positional arg is positional (eg. the stages of 'pipe')
+        self.allow_interspersed_args = interspersed_args
         self.exit_impl = exit
         self.stderr = stderr
         self.ignore_unknown = ignore_unknown
 
     def _process_args(self, largs, rargs, values):
         if not self.ignore_unknown:
-            OptionParser._process_args(self, largs, rargs, values)
+            self._process_arg_runs(largs, rargs, values)
         else:
             # from http://stackoverflow.com/questions/1885161/
             #    how-can-i-get-optparses-optionparser-to-ignore-invalid-options
             while rargs:
                 try:
-                    OptionParser._process_args(self, largs, rargs, values)
+                    self._process_arg_runs(largs, rargs, values)
                     if not self.allow_interspersed_args:
                         return
                 except (BadOptionError, AmbiguousOptionError) as e:
@@ -46,6 +103,30 @@ class CustomStderrOptionParser(OptionParser):
                     # pass on the remainig arguments
                     largs.append(e.opt_str)
 
+    def _process_arg_runs(self, largs, rargs, values):
+        # Same as OptionParser._process_args, except that runs of
+        # positional args are moved to largs at once. OptionParser
+        # moves them one by one with del rargs[0], which is quadratic
+        # in the number of args.
+        while rargs:
+            arg = rargs[0]
+            if arg == "--":
+                del rargs[0]
+                return
+            elif arg[0:2] == "--":
+                self._process_long_opt(rargs, values)
+            elif arg[:1] == "-" and len(arg) > 1:
+                self._process_short_opts(rargs, values)
+            elif self.allow_interspersed_args:
+                run_end = 1
+                while run_end < len(rargs) and not (
+                        rargs[run_end][:1] == "-" and len(rargs[run_end]) > 1):
+                    run_end += 1
+                largs.extend(islice(rargs, 0, run_end))
+                del rargs[:run_end]
+            else:
+                return
+
     def print_usage(self, file=None):
         return OptionParser.print_usage(self, file or self.stderr)
 
@@ -89,6 +170,21 @@ class CommandHelpFormatter(CustomHelpFormatter):
         self.command_definition = command_definition
         self.get_has_global_options = get_has_global_options
 
+    def format_option(self, option):
+        # the descriptions are not stored in the options, which
+        # commands with the same kwargs share (see add_parser_option)
+        option_help = self.command_definition.spec.options.get('option_help')
+        description = (option_help or {}).get(option.dest)
+        if description is not None:
+            from copy import copy
+            described = copy(option)
+            if option.help:
+                description = "%s, %s" % (description, option.help)
+            described.help = description
+            self.option_strings[described] = self.option_strings[option]
+            option = described
+        return CustomHelpFormatter.format_option(self, option)
+
     def format_usage(self, usage):
         command_help = self.command_definition.doc
         if command_help is not None:
@@ -138,6 +234,9 @@ class GlobalOptionParser(CustomStderrOptionParser):
             usage=GlobalOptionParser.USAGE,
             **kwargs)
         self.command_definitions = command_definitions
+        # writes the help of all the commands to the file it is passed,
+        # see MicroCLI.write_commands_help
+        self.commands_help_writer = None
         self.allow_interspersed_args = False
 
     def expand_prog_name(self, s):
@@ -148,11 +247,75 @@ class GlobalOptionParser(CustomStderrOptionParser):
         return CustomStderrOptionParser.expand_prog_name(
             self, s) % global_options
 
+    def add_timings_option(self):
+        """ Registers --timings, which reports the time spent in
+            each phase of the invocation on stderr """
+        self.add_option(
+            '--timings',
+            action='store_true',
+            default=False,
+            dest='timings',
+            help='Print the time spent in each phase to stderr')
+
+    def add_profile_options(self):
+        """ Registers the options profiling the command (see
+            microcli_profile): --profile, --memprofile, --profile-output,
+            --profile-top and --profile-all """
+        self.add_option(
+            '--profile',
+            action='store_true',
+            default=False,
+            dest='profile',
+            help='Profile the command with cProfile, ' +
+                 'print the top functions to stderr')
+        self.add_option(
+            '--memprofile',
+            action='store_true',
+            default=False,
+            dest='memprofile',
+            help='Trace the memory allocations of the command ' +
+                 '(python 3.4+), print the top lines to stderr')
+        self.add_option(
+            '--profile-output',
+            default=None,
+            dest='profile_output',
+            metavar='FILE',
+            help='Write the profile to FILE as pstats, or as ' +
+                 'sampled collapsed stacks if FILE ends with .collapsed')
+        self.add_option(
+            '--profile-top',
+            type='int',
+            default=20,
+            dest='profile_top',
+            metavar='N',
+            help='Number of functions or lines to print')
+        self.add_option(
+            '--profile-all',
+            action='store_true',
+            default=False,
+            dest='profile_all',
+            help='Also profile finding the command and parsing its options')
+
+    def add_output_format_option(self, formats, default=None):
+        """ Registers --output-format, choosing one of the encoders in
+            formats (eg. MicroCLI.output_encoders) for command results. """
+        choices = sorted(formats)
+        self.add_option(
+            '--output-format',
+            choices=choices,
+            default=default,
+            dest='output_format',
+            metavar='FORMAT',
+            help='Encode results as %s' % ", ".join(choices))
+
     def print_help(self, file=None):
         """ recursively call all command parsers' helps """
         output = file or self.stderr
         CustomStderrOptionParser.print_help(self, output)
         output.write("\nCommands:\n")
+        if self.commands_help_writer is not None:
+            self.commands_help_writer(output)
+            return
         for command_def in self.command_definitions.values():
             command_def.opt_parser.print_help(output)
             output.write("\n")
@@ -176,40 +339,537 @@ class CommandOptionParser(CustomStderrOptionParser):
         pass
 
 
-class CommandDefinition(object):
+class NativeParseFallback(Exception):
+    """ Raised by NativeOptionTable.parse for input it leaves to optparse """
+    pass
+
+
+def parse_native_int(value):
+    # optparse reads a leading 0 as a hex, binary or octal prefix
+    if value[:1] == "0" and value != "0":
+        raise NativeParseFallback()
+    return int(value)
+
+
+NATIVE_STORE = 0
+NATIVE_CONST = 1
+NATIVE_FALLBACK = 2
+NATIVE_CONVERTERS = {
+    'int': parse_native_int,
+    'float': float,
+    'string': None
+}
+
+
+class NativeOptionTable(object):
+    """ Parses simple option specs in a single pass over the arguments,
+        using a dict from option strings to actions.
+        Anything beyond the common case (help, errors, unknown or
+        abbreviated options, option clusters, "--" in the args of a parser
+        ignoring unknown options) raises NativeParseFallback, so the caller
+        can rerun optparse on the same arguments and get exactly the same
+        results and error messages. """
+
+    def __init__(self, options, defaults, interspersed=True,
+                 ignore_unknown=False):
+        # options maps option strings to (action, dest, converter or const)
+        self.options = options
+        self.defaults = defaults
+        self.interspersed = interspersed
+        # CustomStderrOptionParser keeps parsing options after "--" then
+        self.ignore_unknown = ignore_unknown
+
+    @classmethod
+    def from_option_parser(cls, parser):
+        """ Returns the table equivalent to an optparse parser,
+            or None if it uses features the table doesn't support. """
+        options = {}
+        for option in parser.option_list:
+            if option.action == 'store_true':
+                entry = (NATIVE_CONST, option.dest, True)
+            elif option.action == 'store_false':
+                entry = (NATIVE_CONST, option.dest, False)
+            elif option.action == 'store_const':
+                entry = (NATIVE_CONST, option.dest, option.const)
+            elif option.action == 'store' and option.nargs == 1 and \
+                    option.type in NATIVE_CONVERTERS:
+                entry = (NATIVE_STORE, option.dest,
+                         NATIVE_CONVERTERS[option.type])
+            elif option.action == 'help':
+                entry = (NATIVE_FALLBACK, None, None)
+            else:
+                return None
+            for opt_str in option._short_opts + option._long_opts:
+                options[opt_str] = entry
+        return cls(
+            options,
+            parser.get_default_values().__dict__,
+            parser.allow_interspersed_args,
+            getattr(parser, 'ignore_unknown', False))
+
+    def parse(self, args):
+        values = dict(self.defaults)
+        positional_args = []
+        options = self.options
+        arg_ix = 0
+        arg_count = len(args)
+        while arg_ix < arg_count:
+            arg = args[arg_ix]
+            if arg[:1] != "-" or arg == "-":
+                if not self.interspersed:
+                    break
+                positional_args.append(arg)
+                arg_ix += 1
+                continue
+            arg_ix += 1
+            if arg == "--":
+                if self.ignore_unknown:
+                    raise NativeParseFallback()
+                break
+            value = None
+            if arg[:2] == "--" and "=" in arg:
+                arg, value = arg.split("=", 1)
+            action, dest, param = options.get(
+                arg, (NATIVE_FALLBACK, None, None))
+            if action == NATIVE_CONST and value is None:
+                values[dest] = param
+            elif action == NATIVE_STORE:
+                if value is None:
+                    if arg_ix == arg_count:
+                        raise NativeParseFallback()
+                    value = args[arg_ix]
+                    arg_ix += 1
+                if param is not None:
+                    try:
+                        value = param(value)
+                    except ValueError:
+                        raise NativeParseFallback()
+                values[dest] = value
+            else:
+                raise NativeParseFallback()
+        positional_args.extend(islice(args, arg_ix, None))
+        return values, positional_args
+
+
+class OutputBuffer(object):
+    """ Collects writes to a stream and passes them on in batches.
+        The flush policy is one of
+        'line': every write is flushed immediately,
+        'size': writes are flushed once flush_size characters are buffered,
+        'time': like 'size', but written data also never waits more than
+                flush_interval seconds: a timer thread flushes it even if
+                the writer is blocked (eg. a generator waiting for input).
+        close must be called once the writer is done. """
+
+    def __init__(self, stream, policy="size", flush_size=1 << 16,
+                 flush_interval=1.0):
+        self.stream = stream
+        self.policy = policy
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.chunks = []
+        self.size = 0
+        # total size of the data written
+        self.written = 0
+        # the timer flushing the chunks of the 'time' policy, and the
+        # lock it shares with the writer
+        self.timer = None
+        self.lock = None
+        self.closed = False
+        if policy == "time":
+            import threading
+            self.lock = threading.Lock()
+
+    def write(self, data):
+        if self.lock is None:
+            self.add_chunk(data)
+        else:
+            with self.lock:
+                self.add_chunk(data)
+
+    def add_chunk(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        self.written += len(data)
+        if self.policy == "line" or self.size >= self.flush_size:
+            self.write_chunks()
+        elif self.lock is not None and self.timer is None:
+            import threading
+            self.timer = threading.Timer(
+                self.flush_interval, self.flush_on_deadline)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush_on_deadline(self):
+        with self.lock:
+            self.timer = None
+            if self.closed:
+                return
+            try:
+                self.write_chunks()
+            except (IOError, OSError):
+                # the chunks are kept, the writer gets the
+                # error when it flushes them
+                pass
+
+    def write_chunks(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.chunks:
+            # joins str or bytes, whichever the chunks are
+            self.stream.write(self.chunks[0][:0].join(self.chunks))
+            self.chunks = []
+            self.size = 0
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+    def flush(self):
+        if self.lock is None:
+            self.write_chunks()
+        else:
+            with self.lock:
+                self.write_chunks()
+
+    def close(self):
+        """ Stops the timer, without flushing """
+        if self.lock is not None:
+            with self.lock:
+                self.closed = True
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+
+def to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode("utf-8")
+
+
+class OutputEncoder(object):
+    """ Base class of the encoders selected by --output-format.
+        encode returns the bytes of a single record, a new
+        encoder is created for each result. """
+
+    def encode(self, record):
+        raise NotImplementedError()
+
+
+class JsonLinesEncoder(OutputEncoder):
+    """ One JSON document per line, values JSON can't represent
+        are written as strings. """
+
+    def __init__(self):
+        import json
+        self.encoder = json.JSONEncoder(separators=(",", ":"), default=str)
+
+    def encode(self, record):
+        return to_bytes(self.encoder.encode(record) + "\n")
+
+
+class CsvEncoder(OutputEncoder):
+    """ One row per record. Lists and tuples are rows, dicts are rows
+        of their values preceded by a header of the keys of the first
+        record, anything else is a row with a single column. """
+
+    delimiter = ","
+
+    def __init__(self):
+        import csv
+        self.buffer = new_string_buffer()
+        self.writer = csv.writer(
+            self.buffer, delimiter=self.delimiter, lineterminator="\n")
+        self.fields = None
+
+    def encode(self, record):
+        if isinstance(record, dict):
+            if self.fields is None:
+                self.fields = list(record)
+                self.writer.writerow(self.fields)
+            row = [record.get(field, "") for field in self.fields]
+        elif isinstance(record, (list, tuple)):
+            row = record
+        else:
+            row = [record]
+        self.writer.writerow(row)
+        data = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return to_bytes(data)
+
+
+class TsvEncoder(CsvEncoder):
+
+    delimiter = "\t"
+
+
+class LengthPrefixedEncoder(OutputEncoder):
+    """ Each record is a 4 byte big-endian length followed by that many
+        bytes: bytes are written as they are, strings UTF-8 encoded and
+        anything else as JSON. """
+
+    def __init__(self):
+        import json
+        import struct
+        self.header = struct.Struct(">I")
+        self.json_encoder = json.JSONEncoder(
+            separators=(",", ":"), default=str)
+
+    def encode(self, record):
+        if is_string(record) or isinstance(record, bytes):
+            payload = to_bytes(record)
+        else:
+            payload = to_bytes(self.json_encoder.encode(record))
+        return self.header.pack(len(payload)) + payload
+
+
+def get_binary_stream(stream):
+    # python 3 text streams wrap a binary buffer
+    return getattr(stream, 'buffer', stream)
+
+
+def is_text_stream(stream):
+    # eg. io.StringIO, which has no binary buffer
+    import io
+    return isinstance(stream, io.TextIOBase)
+
+
+def to_text(data):
+    try:
+        # keeps the bytes which aren't utf-8 (python 3)
+        return data.decode("utf-8", "surrogateescape")
+    except LookupError:
+        return data.decode("utf-8", "replace")  # python 2
+
+
+# Identical signatures of commands share a single tuple, see share_tuple
+shared_tuples = {}
+
+
+def share_tuple(items, key=None):
+    """ Returns a tuple of items, the same tuple for all equal items.
+        key identifies the items if equality isn't enough (True == 1). """
+    items = tuple(items)
+    try:
+        return shared_tuples.setdefault(items if key is None else key, items)
+    except TypeError:
+        return items  # unhashable items
+
+
+def get_signature_key(args_with_defaults):
+    return tuple(
+        (name, type(default), default) for name, default in args_with_defaults)
+
+
+def get_bigrams(name):
+    # '^' and '$' mark the ends, so even one letter names have bigrams
+    padded = "^%s$" % name
+    return set(padded[i:i + 2] for i in range(len(padded) - 1))
+
+
+def get_edit_distance(a, b, max_distance):
+    """ Edit distance of a and b counting insertions, deletions,
+        substitutions and transpositions of adjacent characters, or
+        max_distance + 1 if it is more than max_distance """
+    too_far = max_distance + 1
+    if abs(len(a) - len(b)) > max_distance:
+        return too_far
+    # Only cells within max_distance of the diagonal can be
+    # within max_distance, the rest are left at too_far.
+    before_previous = None
+    previous = [min(j, too_far) for j in range(len(b) + 1)]
+    for i in range(1, len(a) + 1):
+        char_a = a[i - 1]
+        current = [too_far] * (len(b) + 1)
+        current[0] = min(i, too_far)
+        for j in range(max(1, i - max_distance),
+                       min(len(b), i + max_distance) + 1):
+            char_b = b[j - 1]
+            distance = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b))
+            if i > 1 and j > 1 and char_a == b[j - 2] and \
+                    a[i - 2] == char_b:
+                distance = min(distance, before_previous[j - 2] + 1)
+            current[j] = min(distance, too_far)
+        if min(current) == too_far:
+            return too_far
+        before_previous, previous = previous, current
+    return previous[-1]
+
+
+class CommandIndex(object):
+    """ Index of the command names of a class. Names are looked up by
+        prefix with a binary search of the sorted names, which takes a
+        number of string comparisons logarithmic in the number of
+        commands. Suggestions for mistyped names only check the names
+        which share enough bigrams with them to be within the edit
+        distance, found through an index of bigrams. The index is
+        stored next to the command manifest (see
+        MicroCLI.suggest_commands); without one, it is only built for
+        the second suggestion of a process, as a single suggestion
+        costs less by checking the names directly. """
+
+    __slots__ = ('names', 'names_by_bigram', 'names_by_length',
+                 'suggestion_count')
+
+    def __init__(self, names, names_by_bigram=None, names_by_length=None):
+        self.names = tuple(sorted(names))
+        self.names_by_bigram = names_by_bigram
+        self.names_by_length = names_by_length
+        self.suggestion_count = 0
+
+    def get_completions(self, prefix, limit=None):
+        """ Returns the names starting with prefix, in order """
+        from bisect import bisect_left
+        completions = []
+        for ix in range(bisect_left(self.names, prefix), len(self.names)):
+            if not self.names[ix].startswith(prefix) or \
+                    len(completions) == limit:
+                break
+            completions.append(self.names[ix])
+        return completions
+
+    def build_bigram_index(self):
+        names_by_bigram = {}
+        names_by_length = {}
+        for ix, name in enumerate(self.names):
+            for bigram in get_bigrams(name):
+                postings = names_by_bigram.get(bigram)
+                if postings is None:
+                    names_by_bigram[bigram] = [ix]
+                else:
+                    postings.append(ix)
+            names_by_length.setdefault(len(name), []).append(ix)
+        self.names_by_bigram = names_by_bigram
+        self.names_by_length = names_by_length
+
+    def suggest(self, name, max_distance=None, limit=3):
+        """ Returns up to limit names within max_distance edits of name
+            (by default 1 for names of up to 4 characters, 2 for longer
+            ones), the closest first """
+        if max_distance is None:
+            max_distance = 1 if len(name) <= 4 else 2
+        self.suggestion_count += 1
+        if self.names_by_bigram is None:
+            if self.suggestion_count == 1:
+                return self.select_suggestions(
+                    name, range(len(self.names)), max_distance, limit)
+            self.build_bigram_index()
+        bigrams = get_bigrams(name)
+        # an edit changes at most three bigrams (a transposition)
+        min_shared = len(bigrams) - 3 * max_distance
+        if min_shared > 0:
+            # only the names sharing a bigram are counted
+            shared = {}
+            for bigram in bigrams:
+                for ix in self.names_by_bigram.get(bigram, ()):
+                    shared[ix] = shared.get(ix, 0) + 1
+            candidates = [
+                ix for ix, count in shared.items() if count >= min_shared]
+        else:
+            candidates = []
+            for length in range(len(name) - max_distance,
+                                len(name) + max_distance + 1):
+                candidates.extend(self.names_by_length.get(length, ()))
+        return self.select_suggestions(name, candidates, max_distance, limit)
+
+    def select_suggestions(self, name, candidates, max_distance, limit):
+        """ Returns up to limit of the names at the indexes in candidates
+            within max_distance edits of name, the closest first """
+        suggestions = []
+        for ix in candidates:
+            candidate = self.names[ix]
+            if abs(len(candidate) - len(name)) > max_distance:
+                continue
+            distance = get_edit_distance(name, candidate, max_distance)
+            if distance <= max_distance:
+                suggestions.append((distance, candidate))
+        return [candidate for _, candidate in sorted(suggestions)[:limit]]
+
+
+class CommandSpec(object):
+    """ Instance independent description of a command: everything
+        which can be derived from the command method itself.
+        Specs are computed once per class and shared by all instances. """
+
+    # generated CLIs may have thousands of commands
+    __slots__ = (
+        'name', 'fun', 'options', 'args_with_defaults', 'arg_names',
+        'varargs', 'doc', 'native_option_table')
 
     def __init__(
             self,
             name,
-            opt_parser,
-            args_with_defaults,
             fun,
+            options,
+            args_with_defaults,
             varargs=None,
             doc=None):
         self.name = name
-        self.opt_parser = opt_parser
-        self.args_with_defaults = args_with_defaults
-        self.arg_names = [a for a, d in args_with_defaults if d == ARG_NO_DEFAULT_VALUE]
         self.fun = fun
+        self.options = options
+        args_with_defaults = tuple(args_with_defaults)
+        self.args_with_defaults = share_tuple(
+            args_with_defaults, get_signature_key(args_with_defaults))
+        self.arg_names = share_tuple(
+            a for a, d in self.args_with_defaults if d == ARG_NO_DEFAULT_VALUE)
         self.varargs = varargs
         self.doc = doc
+        # compiled by MicroCLI.get_native_option_table when first needed,
+        # False if the command's options can't be handled natively.
+        self.native_option_table = None
+
 
-    def combine_args(self, cli, original_positional_args, kwargs):
+class CommandDefinition(object):
+
+    __slots__ = (
+        'spec', 'name', 'parser_factory', '_opt_parser', 'native_option_table',
+        'args_with_defaults', 'arg_names', 'fun', 'varargs', 'doc')
+
+    def __init__(self, spec, parser_factory=None):
+        self.spec = spec
+        self.name = spec.name
+        self.parser_factory = parser_factory
+        self._opt_parser = None
+        self.native_option_table = None
+        self.args_with_defaults = spec.args_with_defaults
+        self.arg_names = spec.arg_names
+        self.fun = spec.fun
+        self.varargs = spec.varargs
+        self.doc = spec.doc
+
+    @property
+    def opt_parser(self):
+        # Parsers are built on first use, so running a command
+        # doesn't pay for the parsers of all the other commands.
+        if self._opt_parser is None:
+            self._opt_parser = self.parser_factory(self)
+        return self._opt_parser
+
+    @opt_parser.setter
+    def opt_parser(self, opt_parser):
+        self._opt_parser = opt_parser
+
+    def combine_args(self, cli, positional_args, kwargs):
         # Converts kwargs to positional args if the function accepts
         # varargs (because python 2 can't call functions with both)
-        pos_args = list(original_positional_args)
+        if len(self.arg_names) == len(self.args_with_defaults):
+            return positional_args  # there are no kwargs to insert
         combined_arg_list = []
-        arg_ix = 0
-        for arg_ix in xrange(0, len(self.args_with_defaults)):
-            arg_name, default_value = self.args_with_defaults[arg_ix]
+        pos_ix = 0
+        for arg_name, default_value in self.args_with_defaults:
             # If the argument has a default value then
             # we should look for it in the kwargs dict
             if default_value != ARG_NO_DEFAULT_VALUE:
-                arg_value = kwargs.get(arg_name, default_value)
+                combined_arg_list.append(kwargs.get(arg_name, default_value))
             else:
-                arg_value = pos_args.pop(0)
-            combined_arg_list.append(arg_value)
-        return combined_arg_list + pos_args
+                combined_arg_list.append(positional_args[pos_ix])
+                pos_ix += 1
+        combined_arg_list.extend(islice(positional_args, pos_ix, None))
+        return combined_arg_list
 
     def verify_function_arity(self, cli, args):
         # receives the list of command line arguments
@@ -227,33 +887,375 @@ class CommandDefinition(object):
             cli.write("Expected arguments: %s" % ", ".join(self.arg_names))
             cli.exit(1)
 
-    def run(self, cli, args):
+    def run(self, cli, args, inputs=None):
+        """ Runs the command with the command line args. The objects in
+            inputs (eg. the result of the previous command of a pipeline)
+            are passed after the positional args. """
+        started = timer()
         try:
-            parser_options, positional_args = self.opt_parser.parse_args(args)
-            kwargs = parser_options.__dict__
+            kwargs, positional_args = cli.parse_command_args(self, args)
         except UnboundLocalError as e:
             cli.write("Error parsing command arguments")
             return 1  # same as sys.exit(1)
         else:
-            self.verify_function_arity(cli, positional_args)
-            if self.varargs is None:
-                return self.fun(cli, *positional_args, **kwargs)
-            return self.fun(cli, *self.combine_args(cli, positional_args, kwargs))
+            parsed = timer()
+            cli.record_timing("parse", parsed - started)
+            if cli.profiler is not None:
+                cli.profiler.start()
+            try:
+                return self.execute(cli, positional_args, kwargs, inputs)
+            finally:
+                cli.record_timing("execute", timer() - parsed)
+
+    def execute(self, cli, positional_args, kwargs, inputs=None):
+        if self.varargs is not None and \
+                self.spec.options.get('stream_varargs'):
+            return self.run_streaming(
+                cli, positional_args, kwargs, inputs)
+        if inputs is not None:
+            positional_args = list(positional_args)
+            positional_args.extend(inputs)
+        self.verify_function_arity(cli, positional_args)
+        if self.spec.options.get('arg_types'):
+            # the varargs are passed one by one, a compact
+            # container would be unpacked right away
+            converted_args = self.convert_args(
+                cli, positional_args[:len(self.arg_names)],
+                positional_args[len(self.arg_names):], "list")
+            if converted_args is None:
+                return 1
+            required_args, varargs = converted_args
+            positional_args = list(required_args)
+            positional_args.extend(varargs)
+        if self.varargs is None:
+            return self.call(cli, positional_args, kwargs)
+        return self.call(
+            cli, self.combine_args(cli, positional_args, kwargs), {})
+
+    def call(self, cli, args, kwargs):
+        if self.spec.options.get('cache'):
+            return cli.call_cached(self, args, kwargs)
+        return self.fun(cli, *args, **kwargs)
+
+    def run_streaming(self, cli, positional_args, kwargs, inputs=None):
+        # The required args are the first items of the stream, the rest
+        # of it is passed lazily as the single item of the varargs.
+        stream = stream_args(cli, positional_args)
+        if inputs is not None:
+            stream = chain(stream, inputs)
+        required_args = list(islice(stream, len(self.arg_names)))
+        self.verify_function_arity(cli, required_args)
+        if self.spec.options.get('arg_types'):
+            converted_args = self.convert_args(
+                cli, required_args, stream, cli.vararg_container)
+            if converted_args is None:
+                return 1
+            required_args, stream = converted_args
+        return self.fun(
+            cli, *self.combine_args(cli, required_args, kwargs) + [stream])
+
+    def convert_args(self, cli, required_args, varargs, container):
+        """ Converts the args to the types declared in @command, the
+            varargs into container (see convert_arg_values). Returns the
+            converted required args and varargs, or None once the bad
+            values are reported. """
+        arg_types = self.spec.options['arg_types']
+        errors = []
+        converted_args = []
+        for arg_name, value in zip(self.arg_names, required_args):
+            type_name = arg_types.get(arg_name)
+            if type_name is not None:
+                try:
+                    value = ARG_TYPES[type_name][0](value)
+                except (ValueError, TypeError, OverflowError):
+                    errors.append("Invalid %s value for %s: %r" % (
+                        type_name, arg_name, value))
+            converted_args.append(value)
+        type_name = arg_types.get(self.varargs)
+        if type_name is not None:
+            varargs, bad_values = convert_arg_values(
+                varargs, type_name, container)
+            if bad_values:
+                errors.append("Invalid %s values for %s: %s" % (
+                    type_name, self.varargs,
+                    ", ".join(repr(value) for value in bad_values)))
+        if errors:
+            cli.write("\n".join(errors))
+            cli.exit(1)
+            return None
+        return converted_args, varargs
+
 
-def command(parser_options=None):
+class CommandGroup(object):
+    """ The commands of another MicroCLI subclass, mounted under a name
+        (see MicroCLI.command_groups): 'tool db migrate' runs the migrate
+        command of the class mounted as 'db'. The class gets the rest of
+        the command line, including its own global options, and starts
+        from the global options of the tool. """
+
+    __slots__ = ('name', 'cli_class')
+
+    def __init__(self, name, cli_class):
+        self.name = name
+        self.cli_class = cli_class
+
+    def run(self, cli, args, inputs=None):
+        group_cli = self.cli_class(
+            ["%s %s" % (cli.argv[0], self.name)] + list(args),
+            cli.stdout, cli.stdin)
+        group_cli.global_optparser.stderr = cli.stdout
+        # the defaults of the options the group adds, then the
+        # values of the options of the tool
+        global_options = \
+            group_cli.global_optparser.get_default_values().__dict__
+        global_options.update(getattr(cli, 'global_options', {}))
+        group_cli.arg_list = group_cli.read_global_options(
+            group_cli.argv[1:], global_options)
+        group_cli.script_name = group_cli.argv[0]
+        if inputs is not None:
+            # a stage of a pipe: the result goes to the next stage
+            return group_cli.run_pipeline([group_cli.arg_list], inputs)
+        if in_event_loop():
+            # the caller awaits the commands of the group
+            from microcli_async import dispatch
+            return dispatch(group_cli, group_cli.arg_list)
+        return group_cli.dispatch(group_cli.arg_list)
+
+
+class PhaseTimer(object):
+    """ Context manager recording the time spent in its block as a
+        phase of the invocation, see MicroCLI.record_timing """
+
+    __slots__ = ('cli', 'phase', 'started')
+
+    def __init__(self, cli, phase):
+        self.cli = cli
+        self.phase = phase
+
+    def __enter__(self):
+        self.started = timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.cli.record_timing(self.phase, timer() - self.started)
+
+
+class CommandInvocation(object):
+    """ Context manager around running a command, recording its
+        metrics (see MicroCLI.record_metrics) once the block sets
+        exit_status or exits the interpreter. Shared by the synchronous
+        MicroCLI.dispatch and the one of microcli_async. """
+
+    __slots__ = ('cli', 'command_def', 'exit_status', 'started',
+                 'output_size')
+
+    def __init__(self, cli, command_def):
+        self.cli = cli
+        self.command_def = command_def
+        self.exit_status = None
+
+    def __enter__(self):
+        self.started = timer()
+        self.output_size = self.cli.output_size
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        exit_status = self.exit_status
+        if exc_type is not None:
+            if not issubclass(exc_type, SystemExit):
+                return
+            # eg. MicroCLI.exit after a usage error
+            exit_status = get_exit_status(getattr(exc_value, 'code', None))
+        self.cli.record_metrics(
+            self.command_def, exit_status, timer() - self.started,
+            self.cli.output_size - self.output_size)
+
+
+def import_object(target):
+    """ Returns the object named by target, 'package.module:name' """
+    module_name, _, name = target.partition(":")
+    __import__(module_name)
+    obj = sys.modules[module_name]
+    for attr in name.split("."):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def iter_entry_points(group):
+    """ Returns the entry points registered under group by the installed
+        distributions. The objects they refer to are not imported. """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        try:
+            from pkg_resources import iter_entry_points as pkg_entry_points
+        except ImportError:
+            return []
+        return list(pkg_entry_points(group))
+    all_entry_points = entry_points()
+    if hasattr(all_entry_points, 'select'):
+        return list(all_entry_points.select(group=group))
+    return list(all_entry_points.get(group, ()))  # python 3.8, 3.9
+
+
+def to_path(value):
+    if not value or "\0" in value:
+        raise ValueError("invalid path: %r" % (value,))
+    return value
+
+
+def to_pathlib_path(value):
+    from pathlib import Path
+    return Path(to_path(value))
+
+
+# The types commands can declare for their args (see command()): the
+# function converting a command line arg, and the array.array typecode
+# the varargs are stored in (None to store them in a list).
+ARG_TYPES = {
+    'int': (int, 'q'),
+    'float': (float, 'd'),
+    # args python 3 decoded with surrogateescape get their bytes back
+    'bytes': (getattr(os, 'fsencode', to_bytes), None),
+    'path': (to_path, None),
+    # args annotated pathlib.Path (or one of its subclasses)
+    'Path': (to_pathlib_path, None),
+}
+# values converted at a time: bounds the memory of the
+# intermediate lists, and amortizes the cost of extending the arrays
+ARG_CONVERSION_CHUNK_SIZE = 1 << 14
+
+
+def get_arg_type_name(arg_type):
+    """ Returns the name of arg_type (a type or its name) in ARG_TYPES,
+        None for other types """
+    if is_string(arg_type):
+        return arg_type if arg_type in ARG_TYPES else None
+    if getattr(arg_type, '__module__', None) == 'pathlib':
+        from pathlib import Path
+        if isinstance(arg_type, type) and issubclass(arg_type, Path):
+            return 'Path'
+        return None
+    for type_name, builtin_type in (
+            ('int', int), ('float', float), ('bytes', bytes)):
+        if arg_type is builtin_type:
+            return type_name
+    return None
+
+
+def get_array_typecode(typecode):
+    from array import array
+    try:
+        array(typecode)
+    except ValueError:
+        return 'l'  # python 2 has no 'q', its long is 64 bits on unix
+    return typecode
+
+
+def convert_arg_values(values, type_name, container="array"):
+    """ Converts values (command line args, or any iterable of them) to
+        type_name. Numeric values are stored in an array.array, or a
+        numpy array if container is 'numpy' and numpy is installed; all
+        values are stored in a list if container is 'list'. Returns the
+        converted values and the list of values which can't be
+        converted. """
+    from array import array
+    convert, typecode = ARG_TYPES[type_name]
+    if typecode is not None and container != "list":
+        converted = array(get_array_typecode(typecode))
+        extend = converted.fromlist
+    else:
+        converted = []
+        extend = converted.extend
+    bad_values = []
+    values = iter(values)
+    while True:
+        chunk = list(islice(values, ARG_CONVERSION_CHUNK_SIZE))
+        if not chunk:
+            break
+        try:
+            extend(list(map(convert, chunk)))
+        except (ValueError, TypeError, OverflowError):
+            # find the bad values one by one, but only in this chunk
+            for value in chunk:
+                try:
+                    extend([convert(value)])
+                except (ValueError, TypeError, OverflowError):
+                    bad_values.append(value)
+    if container == "numpy" and isinstance(converted, array):
+        try:
+            import numpy
+        except ImportError:
+            return converted, bad_values
+        # shares the memory of the array
+        converted = numpy.frombuffer(converted, dtype=converted.typecode)
+    return converted, bad_values
+
+
+def command(parser_options=None, stream_varargs=False, cache=None,
+            arg_types=None, option_help=None):
+    """ Marks a method of a MicroCLI subclass as a command.
+        parser_options are passed to the command's option parser.
+        option_help ({kwarg name: description}) describes the command's
+        options in its help.
+        With stream_varargs, '@path' args are replaced with the lines of
+        the file at path and '-' with the lines read from stdin. The
+        varargs of the command then hold a single lazy iterator
+        over the args instead of the args themselves.
+        With cache (True or a dict with the optional keys 'ttl', in
+        seconds, and 'global_options', the names of the global options
+        the result depends on) results are stored on disk and reused
+        while the args and the code of the tool stay the same, see
+        MicroCLI.call_cached. It can't be combined with stream_varargs:
+        the key of the result would have to include every streamed arg,
+        so they would all be read before running the command.
+        The positional args and varargs declared int, float, bytes,
+        path (a str) or pathlib.Path, in arg_types ({arg name: type})
+        or with annotations on python 3, are converted before the
+        command is called. Typed varargs are converted all at once.
+        Only with stream_varargs are numbers stored in a compact
+        container (an array.array, see MicroCLI.vararg_container), which
+        the varargs hold instead of the iterator; otherwise the command
+        gets the converted values one by one, as usual. All the values
+        which can't be converted are reported together. """
     options = {
-        'parser': parser_options
+        'parser': parser_options,
+        'stream_varargs': stream_varargs,
+        'cache': cache,
+        'option_help': option_help
     }
+    if cache and stream_varargs:
+        raise ValueError("commands with stream_varargs can't be cached")
+    for arg_name, arg_type in (arg_types or {}).items():
+        if get_arg_type_name(arg_type) is None:
+            raise ValueError("%s can't be converted to %s" % (
+                arg_name, arg_type))
 
     def decorator(func):
         @wraps(func)
         def wrapper(self, *args, **kwargs):
             return func(self, *args, **kwargs)
-        setattr(wrapper, COMMAND_ATTR, options)
+        declared_types = dict(getattr(func, '__annotations__', {}))
+        declared_types.update(arg_types or {})
+        type_names = dict(
+            (arg_name, get_arg_type_name(arg_type))
+            for arg_name, arg_type in declared_types.items()
+            if arg_name != 'return')
+        command_options = dict(options)
+        # other annotations are left to type checkers
+        command_options['arg_types'] = dict(
+            item for item in type_names.items()
+            if item[1] is not None) or None
+        setattr(wrapper, COMMAND_ATTR, command_options)
         return wrapper
     return decorator
 
 
+def get_qualified_name(cls):
+    # python 2 classes have no __qualname__
+    return getattr(cls, '__qualname__', cls.__name__)
+
+
 def is_string(obj):
     try:
         return isinstance(obj, basestring)
@@ -261,6 +1263,170 @@ def is_string(obj):
         return isinstance(obj, str)
 
 
+def iter_line_args(lines):
+    """ Yields the non-empty lines as args """
+    for line in lines:
+        if not is_string(line):
+            # bytes on python 3, decoded like sys.argv
+            line = line.decode(sys.getfilesystemencoding(), 'surrogateescape')
+        line = line.rstrip("\r\n")
+        if line:
+            yield line
+
+
+def read_response_file(path):
+    with open(path, 'rb') as response_file:
+        if os.fstat(response_file.fileno()).st_size < RESPONSE_FILE_MMAP_SIZE:
+            for arg in iter_line_args(response_file):
+                yield arg
+            return
+        import mmap
+        mapped_file = mmap.mmap(
+            response_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for arg in iter_line_args(iter(mapped_file.readline, b"")):
+                yield arg
+        finally:
+            mapped_file.close()
+
+
+def stream_args(cli, args):
+    """ Lazily expands response files and stdin in args """
+    for arg in args:
+        if arg == STDIN_ARG:
+            for line_arg in iter_line_args(cli.stdin):
+                yield line_arg
+        elif arg[:1] == RESPONSE_FILE_PREFIX and len(arg) > 1:
+            for line_arg in read_response_file(arg[1:]):
+                yield line_arg
+        else:
+            yield arg
+
+
+def is_iterator(obj):
+    # eg. generators, but not lists or strings
+    return hasattr(obj, '__next__') or hasattr(obj, 'next')
+
+
+def get_pipeline_inputs(result):
+    """ Returns the objects the next command of a pipeline receives
+        for the result of the previous one """
+    if result is None:
+        return []
+    if is_iterator(result) or isinstance(result, (list, tuple)):
+        return result
+    return [result]
+
+
+def split_pipeline(args, separator=PIPELINE_SEPARATOR):
+    stage = []
+    for arg in args:
+        if arg == separator:
+            yield stage
+            stage = []
+        else:
+            stage.append(arg)
+    yield stage
+
+
+def is_awaitable(obj):
+    # coroutines returned by async def commands (python 3.5+)
+    return hasattr(obj, '__await__')
+
+
+def in_event_loop():
+    """ True when called by a coroutine run on an asyncio event loop,
+        eg. a batch line run with --event-loop, where coroutines must
+        be awaited rather than run with MicroCLI.run_coroutine """
+    asyncio = sys.modules.get('asyncio')
+    if asyncio is None:
+        return False  # nothing imported asyncio, so no loop is running
+    return asyncio.events._get_running_loop() is not None
+
+
+def get_exit_status(code):
+    # the exit status the interpreter uses for SystemExit(code)
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    return 1
+
+
+def new_string_buffer():
+    try:
+        # python 2: accepts both str and unicode
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+    return StringIO()
+
+
+def run_batch_task(task):
+    """ Runs a line of a batch on a new MicroCLI instance, returning
+        the exit status and the output of the line. """
+    make_cli, global_options, (line_number, line, args) = task
+    cli = make_cli(new_string_buffer())
+    exit_status = cli.run_batch_line(args, global_options)
+    return line_number, line, exit_status, cli.stdout.getvalue()
+
+
+def get_function(method):
+    # unbound methods in python 2 wrap the function
+    return getattr(method, '__func__', method)
+
+
+def pad_defaults(arg_names, defaults):
+    padded_defaults = [ARG_NO_DEFAULT_VALUE] * (len(arg_names) - len(defaults))
+    padded_defaults += list(defaults)
+    return zip(arg_names, padded_defaults)
+
+
+def write_file_atomically(path, data):
+    # write to a temporary file first so concurrent
+    # invocations never read a partially written file.
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as output_file:
+            output_file.write(data)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def get_cache_directory():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "microcli")
+
+
+def make_directories(directory):
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # created concurrently
+
+
+def get_module_source(module_name):
+    module_file = getattr(sys.modules.get(module_name), '__file__', None)
+    if module_file is None:
+        return None
+    source_file = os.path.splitext(module_file)[0] + ".py"
+    if os.path.exists(source_file):
+        return source_file
+    return module_file
+
+
+def get_argspec(func):
+    import inspect
+    try:
+        # inspect.getargspec was removed in python 3.11
+        return inspect.getfullargspec(func)
+    except AttributeError:
+        return inspect.getargspec(func)
+
+
 def get_undecorated_function(func):
     func_name = func.__name__
 
@@ -295,35 +1461,308 @@ def get_undecorated_function(func):
 
 class MicroCLI(object):
 
-    def __init__(self, argv=None, stdout=None):
+    # Path of the file caching the introspected command specs between
+    # runs, True to store it next to the module defining the class.
+    # Subclasses inheriting a path store their manifest next to it.
+    command_manifest = None
+
+    # How results streamed from generators are flushed to stdout:
+    # 'line', 'size', 'time' (see OutputBuffer) or 'auto', which
+    # is 'line' if stdout is a terminal and 'size' otherwise.
+    output_flush_policy = "auto"
+    output_flush_size = 1 << 16
+    output_flush_interval = 1.0
+
+    # Encoders available to --output-format, which tools register
+    # with GlobalOptionParser.add_output_format_option
+    output_encoders = {
+        "jsonl": JsonLinesEncoder,
+        "csv": CsvEncoder,
+        "tsv": TsvEncoder,
+        "binary": LengthPrefixedEncoder,
+    }
+
+    # Path of the database storing the results of commands decorated
+    # with @command(cache=...), None for the user's cache directory.
+    command_cache_path = None
+    # Least recently used results are evicted beyond this many bytes
+    command_cache_size = 64 << 20
+
+    # microcli_profile.CommandProfiler of --profile and --memprofile
+    profiler = None
+
+    # Where the metrics of the commands run are sent (see
+    # microcli_metrics): 'udp://host:port' for a StatsD server or the
+    # path of a file. The MICROCLI_METRICS environment variable
+    # overrides it. Metrics are named <metrics_prefix>.<command>.*,
+    # the prefix defaults to the lowercase name of the class.
+    metrics_target = None
+    metrics_prefix = None
+    metrics_flush_interval = 10.0
+    # characters written by write and write_stream, for the metrics
+    output_size = 0
+
+    # Commands imported only when they are run: names mapped to the
+    # MicroCLI subclass mounted under them as a CommandGroup,
+    # as 'package.module:ClassName'.
+    command_groups = {}
+    # Entry point group under which other distributions register
+    # commands (functions decorated with @command, taking the MicroCLI
+    # instance as their first argument) or command groups (MicroCLI
+    # subclasses), also imported only when they are run.
+    plugin_entry_point_group = None
+
+    # Environment variable set to the socket path on which main() serves
+    # requests (see serve) when the tool is run without arguments, and
+    # <serve_env_var>_IDLE_TIMEOUT to its idle timeout in seconds. None
+    # never serves: each tool opts in with a variable of its own.
+    serve_env_var = None
+
+    # Where the completion index read by microcli_complete.py is saved,
+    # None for the user's cache directory.
+    completion_index_path = None
+
+    # Container of the typed varargs of stream_varargs commands (see
+    # command()): 'array' (array.array), 'numpy' (numpy arrays when
+    # numpy is installed, array.array otherwise) or 'list'.
+    vararg_container = "array"
+
+    # Run the only command starting with a name which is not a command
+    # (eg. 'sub' for 'subtract')
+    command_abbreviations = True
+
+    # Parse options with NativeOptionTable instead of optparse
+    # whenever the options of the parser allow it.
+    native_option_parser = False
+
+    def __init__(self, argv=None, stdout=None, stdin=None):
         self.argv = argv if argv is not None else sys.argv
         self.stdout = stdout or sys.stdout
+        self.stdin = stdin or sys.stdin
+        # (phase, seconds) pairs, see record_timing
+        self.timings = []
+        # called with each phase and its duration as it is recorded
+        self.timing_callbacks = []
+        started = timer()
         self.command_definitions = self.get_all_command_definitions()
+        # definitions of command groups and plugins loaded so far
+        self.lazy_command_definitions = {}
+        self.record_timing("introspection", timer() - started)
         self.global_optparser = GlobalOptionParser(
             exit=self.exit,
             command_definitions=self.command_definitions)
+        self.global_optparser.commands_help_writer = self.write_commands_help
         self.default_command = None
 
+    def record_timing(self, phase, seconds):
+        """ Records the time spent in a phase (one of TIMING_PHASES)
+            of the invocation and passes it to the timing callbacks. A
+            phase may be recorded more than once, eg. the parse and
+            execute phases of each stage of a pipe. The execute phase of
+            a generator ends when it is returned, iterating over it is
+            part of the output phase. """
+        self.timings.append((phase, seconds))
+        for callback in self.timing_callbacks:
+            callback(phase, seconds)
+
+    def write_timings(self, stream=None):
+        """ Writes the total time spent in each recorded phase """
+        stream = stream or sys.stderr
+        totals = {}
+        for phase, seconds in self.timings:
+            totals[phase] = totals.get(phase, 0.0) + seconds
+        phases = [phase for phase in TIMING_PHASES if phase in totals]
+        phases.extend(sorted(set(totals) - set(TIMING_PHASES)))
+        stream.write("".join(
+            "%-16s %10.3f ms\n" % (phase, totals[phase] * 1000.0)
+            for phase in phases))
+
     @classmethod
     def exit(cls, exit_code):
         sys.exit(exit_code)
 
     def write(self, msg, addnewline=True):
-        self.stdout.write(str(msg))
         if addnewline:
-            self.stdout.write("\n")
-
-    def read_global_options(self):
-        global_options, args = self.global_optparser.parse_args(self.argv[1:])
+            msg = "%s\n" % (msg,)
+        else:
+            msg = str(msg)
+        self.stdout.write(msg)
+        self.output_size += len(msg)
+
+    def get_output_buffer(self, stream=None):
+        stream = stream or self.stdout
+        policy = self.output_flush_policy
+        if policy == "auto":
+            isatty = getattr(stream, 'isatty', None)
+            policy = "line" if isatty is not None and isatty() else "size"
+        return OutputBuffer(
+            stream, policy, self.output_flush_size, self.output_flush_interval)
+
+    def write_stream(self, items, stream=None, encode=None):
+        """ Writes each item as it is produced, on its own line unless
+            encode (which returns the data written for an item) is given.
+            Returns the exit status: EXIT_STATUS_BROKEN_PIPE if the
+            reader of stdout went away, 0 otherwise. """
+        output = self.get_output_buffer(stream)
+        try:
+            if encode is None:
+                for item in items:
+                    output.write("%s\n" % (item,))
+            else:
+                for item in items:
+                    output.write(encode(item))
+            output.flush()
+        except (IOError, OSError) as e:
+            if e.errno != errno.EPIPE:
+                raise
+            self.handle_broken_pipe()
+            return EXIT_STATUS_BROKEN_PIPE
+        except Exception:
+            # the items produced before the command failed
+            # are written ahead of the error
+            try:
+                output.flush()
+            except (IOError, OSError):
+                pass
+            raise
+        finally:
+            output.close()
+            self.output_size += output.written
+            if hasattr(items, 'close'):
+                items.close()
+        return 0
+
+    def write_encoded(self, result, output_format):
+        """ Writes result with the encoder of output_format. Iterators and
+            lists are written as a sequence of records. """
+        encoder = self.output_encoders[output_format]()
+        if not (is_iterator(result) or isinstance(result, list)):
+            result = [result]
+        if hasattr(self.stdout, 'flush'):
+            # keep anything already written ahead of the records
+            self.stdout.flush()
+        stream = get_binary_stream(self.stdout)
+        encode = encoder.encode
+        if is_text_stream(stream):
+            # eg. the output buffer of a batch line
+            def encode(record):
+                return to_text(encoder.encode(record))
+        return self.write_stream(result, stream, encode)
+
+    def handle_broken_pipe(self):
+        if self.stdout is sys.stdout:
+            # keeps the interpreter from failing to flush stdout on exit
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            os.close(devnull)
+
+    def read_global_options(self, args=None, global_options=None):
+        """ Parses the global options in args (the command line by
+            default), starting from the global_options dict if given. """
+        if args is None:
+            args = self.argv[1:]
+        if self.native_option_parser:
+            # compiled on every call: global options may be added any time
+            table = NativeOptionTable.from_option_parser(self.global_optparser)
+            if table is not None:
+                if global_options is not None:
+                    table.defaults = global_options
+                try:
+                    self.global_options, args = table.parse(args)
+                    return args
+                except NativeParseFallback:
+                    pass
+        values = None
+        if global_options is not None:
+            values = Values(global_options)
+        global_options, args = self.global_optparser.parse_args(args, values)
         self.global_options = global_options.__dict__
         return args
 
+    def parse_command_args(self, command_definition, args):
+        """ Returns the kwargs dict and the list of positional args """
+        if self.native_option_parser:
+            table = self.get_native_option_table(command_definition)
+            if table:
+                try:
+                    return table.parse(args)
+                except NativeParseFallback:
+                    pass
+        parser_options, positional_args =\
+            command_definition.opt_parser.parse_args(args)
+        return parser_options.__dict__, positional_args
+
+    def get_native_option_table(self, command_definition):
+        spec = command_definition.spec
+        parser_options = spec.options['parser'] or {}
+        customized = [
+            get_function(getattr(type(self), name)) is not
+            get_function(getattr(MicroCLI, name))
+            for name in ('add_parser_option', 'get_parser_option_kwargs',
+                         'get_command_parser')]
+        if any(customized) or set(parser_options) - set(['ignore_unknown']):
+            # Only the parser knows what the options are
+            if command_definition.native_option_table is None:
+                command_definition.native_option_table = \
+                    NativeOptionTable.from_option_parser(
+                        command_definition.opt_parser) or False
+            return command_definition.native_option_table
+        if spec.native_option_table is None:
+            spec.native_option_table = self.compile_native_options(spec)
+        return spec.native_option_table
+
+    @classmethod
+    def compile_native_options(cls, spec):
+        """ Builds the NativeOptionTable equivalent to the
+            options add_parser_option defines for the command """
+        options = {}
+        defaults = {}
+        for arg_name, default_value in spec.args_with_defaults:
+            if default_value == ARG_NO_DEFAULT_VALUE:
+                continue
+            if type(default_value) == bool:
+                entry = (NATIVE_CONST, arg_name, not default_value)
+            elif type(default_value) in [float, int]:
+                entry = (NATIVE_STORE, arg_name,
+                         NATIVE_CONVERTERS[type(default_value).__name__])
+            else:
+                # strings and untyped options are stored as they are
+                entry = (NATIVE_STORE, arg_name, None)
+            defaults[arg_name] = default_value
+            options['--%s' % cls.kwarg_name_to_option_name(arg_name)] = entry
+        parser_options = spec.options['parser'] or {}
+        return NativeOptionTable(
+            options, defaults,
+            ignore_unknown=parser_options.get('ignore_unknown', False))
+
     @classmethod
     def kwarg_name_to_option_name(cls, kwarg_name):
         return kwarg_name.replace("_", "-")
 
     @classmethod
     def add_parser_option(cls, parser, arg_name, default_value):
+        # Commands with the same kwargs share their Option objects,
+        # which are never modified once created.
+        shared_options = cls.__dict__.get(SHARED_OPTIONS_ATTR)
+        if shared_options is None:
+            shared_options = {}
+            setattr(cls, SHARED_OPTIONS_ATTR, shared_options)
+        key = (parser.option_class, arg_name,
+               type(default_value), default_value)
+        try:
+            option = shared_options.get(key)
+        except TypeError:
+            key = option = None  # unhashable default value
+        if option is None:
+            option = parser.option_class(
+                '--%s' % cls.kwarg_name_to_option_name(arg_name),
+                **cls.get_parser_option_kwargs(arg_name, default_value))
+            if key is not None:
+                shared_options[key] = option
+        parser.add_option(option)
+
+    @classmethod
+    def get_parser_option_kwargs(cls, arg_name, default_value):
         action = "store"
         arg_type = None
         bool_actions = {
@@ -344,46 +1783,49 @@ class MicroCLI(object):
                 type(default_value).__name__, default_value)
         if arg_type is not None:
             add_option_kwargs['type'] = arg_type
-        parser.add_option(
-            '--%s' % cls.kwarg_name_to_option_name(arg_name),
-            **add_option_kwargs)
+        return add_option_kwargs
 
-    def get_command_definition(self, cmd_name, cmd_fun, cmd_options):
+    @classmethod
+    def get_command_spec(cls, cmd_name, cmd_fun, cmd_options):
         # get positional arguments
-        argspec = inspect.getargspec(get_undecorated_function(cmd_fun))
+        argspec = get_argspec(get_undecorated_function(cmd_fun))
         # note: the first argument for a command method is self.
         arg_names = argspec.args[1:]
-        defaults = argspec.defaults or []
-        padded_defaults = [ARG_NO_DEFAULT_VALUE] * (len(arg_names) - len(defaults))
-        padded_defaults += list(defaults)
-        args_with_defaults = list(zip(arg_names, padded_defaults))
-        command_definition = CommandDefinition(
+        return CommandSpec(
             cmd_name,
-            None,  # set parser later
-            args_with_defaults,
             cmd_fun,
+            cmd_options,
+            pad_defaults(arg_names, argspec.defaults or []),
             argspec.varargs,
-            self.get_command_description(cmd_fun))
+            cls.get_command_description(cmd_fun))
+
+    def get_command_definition(self, command_spec, parser_factory=None):
+        return CommandDefinition(
+            command_spec, parser_factory or self.get_command_parser)
+
+    def has_global_options(self):
+        # The '-h' global option is always there, hence the > 1
+        return len(self.global_optparser.option_list) > 1
+
+    def get_command_parser(self, command_definition):
+        command_spec = command_definition.spec
         parser_kwargs = {
             'stderr': self.stdout,
             'exit': self.exit
         }
-        if type(cmd_options['parser']) == dict:
-            parser_kwargs.update(cmd_options['parser'])
-        # The '-h' global option is always there, hence the > 1
-        get_has_global_options =\
-            lambda: len(self.global_optparser.option_list) > 1
-        command_definition.opt_parser = CommandOptionParser(
+        if type(command_spec.options['parser']) == dict:
+            parser_kwargs.update(command_spec.options['parser'])
+        opt_parser = CommandOptionParser(
             command_definition,
-            get_has_global_options,
+            self.has_global_options,
             **parser_kwargs)
-        for arg_name, default_value in args_with_defaults:
+        for arg_name, default_value in command_spec.args_with_defaults:
             if default_value != ARG_NO_DEFAULT_VALUE:
                 self.add_parser_option(
-                    command_definition.opt_parser,
+                    opt_parser,
                     arg_name,
                     default_value)
-        return command_definition
+        return opt_parser
 
     @classmethod
     def get_commands(cls):
@@ -394,374 +1836,849 @@ class MicroCLI(object):
                 command_dict[i] = (cmd, getattr(cmd, COMMAND_ATTR))
         return command_dict
 
+    @classmethod
+    def get_command_specs(cls):
+        # Only look at the class' own __dict__, so subclasses
+        # never reuse the specs cached for their parent class.
+        specs = cls.__dict__.get(COMMAND_SPECS_ATTR)
+        if specs is None:
+            specs = cls.load_command_manifest()
+            if specs is None:
+                specs = {}
+                for cmd_name, cmd_data in cls.get_commands().items():
+                    specs[cmd_name] = cls.get_command_spec(cmd_name, *cmd_data)
+                cls.save_command_manifest(specs)
+            setattr(cls, COMMAND_SPECS_ATTR, specs)
+        return specs
+
+    @classmethod
+    def clear_command_specs(cls):
+        """ Drops the cached command specs of this class and its
+            subclasses, eg. after adding commands at runtime. """
+        for attr in (COMMAND_SPECS_ATTR, COMMAND_INDEX_ATTR,
+                     LAZY_COMMANDS_ATTR, HELP_CACHE_ATTR):
+            if attr in cls.__dict__:
+                delattr(cls, attr)
+        for subclass in cls.__subclasses__():
+            subclass.clear_command_specs()
+
+    @classmethod
+    def get_command_index(cls):
+        """ Returns the CommandIndex of the commands of the class,
+            built once per class on first use """
+        index = cls.__dict__.get(COMMAND_INDEX_ATTR)
+        if index is None:
+            index = CommandIndex(
+                set(cls.get_command_specs()) | set(cls.get_lazy_commands()))
+            setattr(cls, COMMAND_INDEX_ATTR, index)
+        return index
+
+    @classmethod
+    def suggest_commands(cls, command_name):
+        """ Returns the names of the commands close to command_name """
+        index = cls.get_command_index()
+        manifest_path = cls.get_command_manifest_path()
+        if index.names_by_bigram is None and manifest_path is not None:
+            cls.load_command_index(index, manifest_path + ".index")
+        return index.suggest(command_name)
+
+    @classmethod
+    def load_command_index(cls, index, index_path):
+        """ Fills in the bigram index of the CommandIndex from the file
+            at index_path, or builds and stores it there if the file is
+            missing or out of date. """
+        stamp = cls.get_manifest_stamp()
+        try:
+            with open(index_path, 'rb') as index_file:
+                stored_stamp, names, names_by_bigram, names_by_length = \
+                    marshal.load(index_file)
+            # plugins may change without the stamp changing
+            if stored_stamp == stamp and names == index.names:
+                index.names_by_bigram = names_by_bigram
+                index.names_by_length = names_by_length
+                return
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+        index.build_bigram_index()
+        write_file_atomically(index_path, marshal.dumps((
+            stamp, index.names, index.names_by_bigram,
+            index.names_by_length)))
+
+    @classmethod
+    def get_lazy_commands(cls):
+        """ Returns the functions loading the command groups and plugins
+            of the class by name. Entry points are only looked up by the
+            first call, and nothing is imported. """
+        lazy_commands = cls.__dict__.get(LAZY_COMMANDS_ATTR)
+        if lazy_commands is None:
+            lazy_commands = {}
+            if cls.plugin_entry_point_group:
+                for entry_point in iter_entry_points(
+                        cls.plugin_entry_point_group):
+                    lazy_commands[entry_point.name] = entry_point.load
+            for group_name, target in cls.command_groups.items():
+                lazy_commands[group_name] = partial(import_object, target)
+            setattr(cls, LAZY_COMMANDS_ATTR, lazy_commands)
+        return lazy_commands
+
+    def load_lazy_command(self, command_name, loader):
+        """ Imports a command group or plugin, returns its definition """
+        obj = loader()
+        if isinstance(obj, type) and issubclass(obj, MicroCLI):
+            return CommandGroup(command_name, obj)
+        command_options = getattr(obj, COMMAND_ATTR, None)
+        if type(command_options) != dict:
+            raise TypeError(
+                "%r is neither a MicroCLI subclass nor a command" % (obj,))
+        return self.get_command_definition(self.get_command_spec(
+            command_name, obj, command_options))
+
+    def lookup_command(self, command_name):
+        """ Returns the definition of the command, loading command
+            groups and plugins on first use, or None """
+        command_def = self.command_definitions.get(command_name)
+        if command_def is None:
+            command_def = self.lazy_command_definitions.get(command_name)
+        if command_def is None:
+            loader = self.get_lazy_commands().get(command_name)
+            if loader is not None:
+                command_def = self.load_lazy_command(command_name, loader)
+                self.lazy_command_definitions[command_name] = command_def
+        return command_def
+
+    @classmethod
+    def get_command_manifest_path(cls):
+        if cls.command_manifest is not True:
+            if not cls.command_manifest:
+                return None
+            if 'command_manifest' in cls.__dict__:
+                return cls.command_manifest
+            # classes sharing the setting get a manifest each
+            return "%s.%s.%s" % (
+                cls.command_manifest, cls.__module__, cls.__name__)
+        source_file = get_module_source(cls.__module__)
+        if source_file is None:
+            return None
+        directory, file_name = os.path.split(source_file)
+        return os.path.join(directory, ".%s.%s.manifest" % (
+            os.path.splitext(file_name)[0], cls.__name__))
+
+    @classmethod
+    def get_command_cache_path(cls):
+        if cls.command_cache_path is not None:
+            return cls.command_cache_path
+        return os.path.join(get_cache_directory(), "%s.%s.sqlite" % (
+            cls.__module__, cls.__name__))
+
+    @classmethod
+    def get_completion_index_path(cls):
+        if cls.completion_index_path is not None:
+            return cls.completion_index_path
+        # scripts are all named __main__, so use the file name instead
+        source_file = get_module_source(cls.__module__) or cls.__module__
+        return os.path.join(get_cache_directory(), "%s.%s.completion" % (
+            os.path.splitext(os.path.basename(source_file))[0], cls.__name__))
+
+    def get_completion_index(self):
+        """ Returns what microcli_complete.py needs to complete command
+            lines: the command names, the options of each command and
+            the global options (mapped to whether they take a value), and
+            how to check whether the index is up to date and rebuild it. """
+        commands = {}
+        for cmd_name, spec in self.get_command_specs().items():
+            commands[cmd_name] = dict(
+                ('--%s' % self.kwarg_name_to_option_name(arg_name),
+                 type(default_value) != bool)
+                for arg_name, default_value in spec.args_with_defaults
+                if default_value != ARG_NO_DEFAULT_VALUE)
+        for cmd_name in self.get_lazy_commands():
+            commands.setdefault(cmd_name, {})
+        global_options = {}
+        for option in self.global_optparser.option_list:
+            for option_string in option._long_opts + option._short_opts:
+                global_options[option_string] = option.takes_value()
+        return {
+            'stamp': self.get_manifest_stamp()[1:],
+            'rebuild_command': [
+                sys.executable, os.path.abspath(self.argv[0]),
+                'completion', '--index-only'],
+            'commands': commands,
+            'global_options': global_options,
+        }
+
+    def save_completion_index(self):
+        """ Returns the path of the saved index, raises IOError or
+            OSError if it can't be written """
+        index_path = self.get_completion_index_path()
+        make_directories(os.path.dirname(index_path))
+        tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as index_file:
+                marshal.dump(self.get_completion_index(), index_file)
+            os.rename(tmp_path, index_path)
+        except (IOError, OSError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return index_path
+
+    def get_completion_hook(self, shell):
+        """ Returns the script registering the completion of this tool
+            in shell (bash, zsh or fish) """
+        try:
+            from shlex import quote
+        except ImportError:
+            from pipes import quote  # python 2
+        import re
+        program = os.path.basename(self.argv[0])
+        helper = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "microcli_complete.py")
+        return COMPLETION_HOOKS[shell] % {
+            'name': re.sub(r"\W", "_", program),
+            'program': quote(program),
+            'helper': " ".join(quote(arg) for arg in [
+                sys.executable, "-S", helper,
+                self.get_completion_index_path()]),
+        }
+
+    def get_command_cache(self):
+        """ Opens the cache of command results. Each call returns a new
+            connection, so threads and forks don't share one. """
+        from microcli_cache import CommandCache
+        path = self.get_command_cache_path()
+        make_directories(os.path.dirname(path))
+        return CommandCache(path, self.command_cache_size)
+
+    def get_cache_key(self, command_definition, args, kwargs):
+        """ Returns the key of the result of the command for args, kwargs
+            and the global options listed in its cache options, or None if
+            some of them can't be serialized (eg. objects passed by a pipe).
+            The key also covers the class and the code of the tool. """
+        import hashlib
+        cache_options = command_definition.spec.options['cache']
+        global_option_names = ()
+        if isinstance(cache_options, dict):
+            global_option_names = cache_options.get('global_options', ())
+        global_options = getattr(self, 'global_options', None) or {}
+        try:
+            cls = type(self)
+            key = marshal.dumps((
+                cls.__module__,
+                get_qualified_name(cls),
+                command_definition.name,
+                tuple(args),
+                tuple(sorted(kwargs.items())),
+                tuple((name, global_options.get(name))
+                      for name in sorted(global_option_names)),
+                self.get_manifest_stamp()))
+        except ValueError:
+            return None
+        return hashlib.sha1(key).hexdigest()
+
+    def call_cached(self, command_definition, args, kwargs):
+        """ Calls the command unless its result for the same args is in
+            the cache. Iterators are stored as lists, results that can't
+            be pickled (eg. coroutines) and non-zero exit statuses
+            are not stored. """
+        import pickle
+        cache_options = command_definition.spec.options['cache']
+        ttl = None
+        if isinstance(cache_options, dict):
+            ttl = cache_options.get('ttl')
+        key = self.get_cache_key(command_definition, args, kwargs)
+        if key is None:
+            return command_definition.fun(self, *args, **kwargs)
+        cache = self.get_command_cache()
+        try:
+            found, value = cache.get(key)
+            if found:
+                is_stream, result = pickle.loads(value)
+                return iter(result) if is_stream else result
+            result = command_definition.fun(self, *args, **kwargs)
+            is_stream = is_iterator(result)
+            if is_stream:
+                result = list(result)
+            if not (is_awaitable(result) or (type(result) == int and result)):
+                try:
+                    value = pickle.dumps((is_stream, result), 2)
+                except (pickle.PicklingError, TypeError, AttributeError):
+                    pass
+                else:
+                    cache.set(key, value, ttl)
+            return iter(result) if is_stream else result
+        finally:
+            cache.close()
+
+    @classmethod
+    def get_manifest_stamp(cls):
+        """ Identifies the code the command specs were derived from:
+            the python version and the modification time and size of
+            every module defining the class or one of its bases. """
+        stamp = [tuple(sys.version_info[:2])]
+        for klass in cls.__mro__:
+            source_file = get_module_source(klass.__module__)
+            if source_file is not None:
+                try:
+                    stat = os.stat(source_file)
+                except OSError:
+                    continue
+                stamp.append((source_file, stat.st_mtime, stat.st_size))
+        return tuple(stamp)
+
+    @classmethod
+    def load_command_manifest(cls):
+        """ Returns the command specs stored in the manifest,
+            or None if there is no up to date manifest. """
+        manifest_path = cls.get_command_manifest_path()
+        if manifest_path is None:
+            return None
+        try:
+            with open(manifest_path, 'rb') as manifest_file:
+                stamp, class_name, commands = marshal.load(manifest_file)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        # the path may be shared with other classes
+        if stamp != cls.get_manifest_stamp() or \
+                class_name != (cls.__module__, get_qualified_name(cls)):
+            return None
+        specs = {}
+        for cmd_name, arg_names, defaults, varargs, doc in commands:
+            cmd_fun = getattr(cls, cmd_name, None)
+            cmd_options = getattr(cmd_fun, COMMAND_ATTR, None)
+            if type(cmd_options) != dict:
+                return None
+            specs[cmd_name] = CommandSpec(
+                cmd_name,
+                cmd_fun,
+                cmd_options,
+                pad_defaults(arg_names, defaults),
+                varargs,
+                doc)
+        return specs
+
+    @classmethod
+    def save_command_manifest(cls, specs):
+        manifest_path = cls.get_command_manifest_path()
+        if manifest_path is None:
+            return
+        commands = []
+        for spec in specs.values():
+            commands.append((
+                spec.name,
+                tuple(a for a, d in spec.args_with_defaults),
+                tuple(d for a, d in spec.args_with_defaults
+                      if d != ARG_NO_DEFAULT_VALUE),
+                spec.varargs,
+                spec.doc))
+        try:
+            data = marshal.dumps((
+                cls.get_manifest_stamp(),
+                (cls.__module__, get_qualified_name(cls)),
+                tuple(commands)))
+        except ValueError:
+            # some default value can't be serialized
+            return
+        write_file_atomically(manifest_path, data)
+
+    @classmethod
+    def get_help_cache(cls):
+        """ Returns the dict of rendered command listings of the class, kept
+            next to the command manifest between runs if there is one. """
+        help_cache = cls.__dict__.get(HELP_CACHE_ATTR)
+        if help_cache is None:
+            help_cache = {}
+            manifest_path = cls.get_command_manifest_path()
+            if manifest_path is not None:
+                try:
+                    with open(manifest_path + ".help", 'rb') as help_file:
+                        stamp, stored_cache = marshal.load(help_file)
+                    if stamp == cls.get_manifest_stamp():
+                        help_cache = stored_cache
+                except (IOError, OSError, EOFError, ValueError, TypeError):
+                    pass
+            setattr(cls, HELP_CACHE_ATTR, help_cache)
+        return help_cache
+
+    @classmethod
+    def save_help_cache(cls, help_cache):
+        manifest_path = cls.get_command_manifest_path()
+        if manifest_path is not None:
+            write_file_atomically(manifest_path + ".help", marshal.dumps(
+                (cls.get_manifest_stamp(), help_cache)))
+
+    def write_commands_help(self, output):
+        """ Writes the help of every command to output. The listing is
+            rendered once per class and program name, and written out
+            as it is rendered. """
+        key = (self.global_optparser.get_prog_name(),
+               self.has_global_options(),
+               tuple(sorted(self.command_definitions)))
+        help_cache = self.get_help_cache()
+        commands_help = help_cache.get(key)
+        if commands_help is not None:
+            output.write(commands_help)
+            return
+        chunks = []
+        for cmd_name in sorted(self.command_definitions):
+            command_help = new_string_buffer()
+            self.command_definitions[cmd_name].opt_parser.print_help(
+                command_help)
+            command_help.write("\n")
+            chunks.append(command_help.getvalue())
+            output.write(chunks[-1])
+        help_cache[key] = "".join(chunks)
+        self.save_help_cache(help_cache)
+
     @classmethod
     def get_command_description(cls, cmd_fun):
         return getattr(cmd_fun, '__doc__', None)
 
     def get_all_command_definitions(self):
         command_definition = {}
-        for cmd_name, cmd_data in self.get_commands().items():
-            cmd_def = self.get_command_definition(cmd_name, *cmd_data)
-            command_definition[cmd_name] = cmd_def
+        # a single bound method for all the definitions
+        parser_factory = self.get_command_parser
+        for cmd_name, cmd_spec in self.get_command_specs().items():
+            command_definition[cmd_name] = self.get_command_definition(
+                cmd_spec, parser_factory)
         return command_definition
 
     @command()
-    def help(self):
-        """ Print usage """
-        self.global_optparser.print_help()
-        pass
+    def help(self, *command_names):
+        """ Print usage, or only that of the given commands """
+        if command_names:
+            for command_name in command_names:
+                command_def = self.find_command([command_name])
+                if command_def is None:
+                    return 1
+                if isinstance(command_def, CommandGroup):
+                    command_def.run(self, ["help"])
+                else:
+                    command_def.opt_parser.print_help(self.stdout)
+            return 0
+        paged = self.is_terminal()
+        output = new_string_buffer() if paged else self.stdout
+        try:
+            self.global_optparser.print_help(output)
+            lazy_commands = sorted(
+                set(self.get_lazy_commands()) - set(self.command_definitions))
+            if lazy_commands:
+                output.write("Loaded when used:\n%s\n" % "".join(
+                    "    %s\n" % name for name in lazy_commands))
+            if paged:
+                self.page(output.getvalue())
+            else:
+                output.flush()
+        except (IOError, OSError) as e:
+            # eg. tool help | head
+            if e.errno != errno.EPIPE:
+                raise
+            self.handle_broken_pipe()
+            return EXIT_STATUS_BROKEN_PIPE
+        return 0
+
+    def is_terminal(self):
+        isatty = getattr(self.stdout, 'isatty', None)
+        return self.stdout is sys.stdout and isatty is not None and isatty()
+
+    def page(self, text):
+        """ Writes text to the terminal, through a pager ($PAGER, less by
+            default) if it has more lines than the terminal """
+        try:
+            from shutil import get_terminal_size
+            rows = get_terminal_size().lines
+        except ImportError:
+            rows = int(os.environ.get('LINES', 24))  # python 2
+        if text.count("\n") < rows:
+            self.stdout.write(text)
+            return
+        import pydoc
+        pydoc.pager(text)
+
+    @command(parser_options={'interspersed_args': False})
+    def pipe(self, *stages):
+        """ Run commands separated by 'then', each receiving the result
+            of the previous one after its own arguments """
+        return self.run_pipeline(list(split_pipeline(stages)))
+
+    @command(option_help={
+        'shell': "The shell to print the hook for",
+        'index_only': "Only save the completion index"})
+    def completion(self, shell="bash", index_only=False):
+        """ Print the hook completing the commands of this tool in
+            --shell (bash, zsh or fish), eg. in ~/.bashrc:
+            eval "$(tool completion)" """
+        try:
+            self.save_completion_index()
+        except (IOError, OSError) as e:
+            # not on stdout, which the shell evaluates. The hook
+            # offers no candidates until the index is saved.
+            sys.stderr.write("Failed to save the completion index: %s\n" % e)
+            if index_only:
+                return 1
+        if index_only:
+            return 0
+        if shell not in COMPLETION_HOOKS:
+            self.write("Unsupported shell '%s' (try %s)" % (
+                shell, ", ".join(sorted(COMPLETION_HOOKS))))
+            return 2
+        return self.get_completion_hook(shell)
+
+    @command(option_help={
+        'fail_fast': "Stop at the first line which fails",
+        'quiet': "Don't list the failed lines and the summary",
+        'jobs': "Number of lines run concurrently",
+        'processes': "Run the lines on a process pool (with --jobs)",
+        'unordered': "Write the output of the lines as they finish",
+        'event_loop': "Run async commands concurrently on one event loop"})
+    def batch(self, script, fail_fast=False, quiet=False, jobs=1,
+              processes=False, unordered=False, event_loop=False):
+        """ Run the command lines in the script file (- for stdin) """
+        batch_options = {
+            'fail_fast': fail_fast,
+            'jobs': jobs,
+            'processes': processes,
+            'ordered': not unordered,
+            'event_loop': event_loop}
+        if script == STDIN_ARG:
+            results = self.run_batch(self.stdin, **batch_options)
+        else:
+            with open(script) as lines:
+                results = self.run_batch(lines, **batch_options)
+        failed = [result for result in results if result[2] != 0]
+        if not quiet:
+            for line_number, line, exit_status in failed:
+                self.write("line %s: exit status %s: %s" % (
+                    line_number, exit_status, line))
+            self.write("%s commands, %s failed" % (len(results), len(failed)))
+        return 1 if failed else 0
 
     @classmethod
     def main(cls, argv=None):
+        # only serve when the tool is run without arguments: the variable
+        # is inherited by child processes, which must still run their
+        # command lines. It is removed so that they don't serve either.
+        if (cls.serve_env_var and argv is None and len(sys.argv) == 1 and
+                os.environ.get(cls.serve_env_var)):
+            socket_path = os.environ.pop(cls.serve_env_var)
+            idle_timeout = os.environ.pop(
+                cls.serve_env_var + "_IDLE_TIMEOUT", None)
+            from microcli_server import ServerRunningError
+            try:
+                cls.serve(socket_path, float(idle_timeout or 0) or None)
+            except ServerRunningError as e:
+                sys.stderr.write("%s\n" % e)
+                cls.exit(1)
+            return
+        imported = timer()
         cli = cls(argv)
+        cli.record_timing("import", imported - IMPORT_STARTED)
         cli.run()
 
+    @classmethod
+    def serve(cls, socket_path, idle_timeout=None, reload=True):
+        """ Runs commands sent by microcli_client.py through the unix
+            domain socket at socket_path, each in a process forked from
+            this one. Stops after idle_timeout seconds without requests.
+            If reload is set and the source of the class changes, the
+            server restarts by executing its original command line.
+            Raises ServerRunningError if another server listens on
+            socket_path. """
+        from microcli_server import CommandServer
+        server = CommandServer(
+            socket_path, cls, idle_timeout=idle_timeout, reload=reload)
+        if server.serve_until_idle() and os.path.isfile(sys.argv[0]):
+            # main removed these from the environment
+            environ = dict(os.environ)
+            if cls.serve_env_var:
+                environ[cls.serve_env_var] = socket_path
+                if idle_timeout:
+                    environ[cls.serve_env_var + "_IDLE_TIMEOUT"] = str(
+                        idle_timeout)
+            os.execve(sys.executable, [sys.executable] + sys.argv, environ)
+
     def run(self):
         self.global_optparser.stderr = self.stdout
+        started = timer()
         self.arg_list = self.read_global_options()
+        self.record_timing("global_options", timer() - started)
         self.script_name = self.argv[0]
+        self.profiler = self.create_profiler()
+        if self.profiler is not None and self.global_options.get(
+                'profile_all'):
+            self.profiler.start()
+        try:
+            exit_status = self.dispatch(self.arg_list)
+            if self.profiler is not None:
+                self.profiler.stop()
+                self.profiler.report()
+            if self.global_options.get('timings'):
+                self.write_timings()
+        finally:
+            # also when a command exits, eg. after a usage error
+            metrics = self.get_metrics()
+            if metrics is not None:
+                metrics.flush()
+        self.exit(exit_status)
+
+    def create_profiler(self):
+        """ Returns the profiler requested by the global options (see
+            GlobalOptionParser.add_profile_options) or None. It profiles
+            the command from the end of option parsing until its result
+            is written, as generators run while their items are written. """
+        options = self.global_options
+        if not (options.get('profile') or options.get('profile_output') or
+                options.get('memprofile')):
+            return None
+        from microcli_profile import CommandProfiler
+        try:
+            return CommandProfiler(
+                cpu=options.get('profile'),
+                memory=options.get('memprofile'),
+                output_path=options.get('profile_output'),
+                top=options.get('profile_top', 20))
+        except ImportError:
+            self.global_optparser.error(
+                "--memprofile requires python 3.4 or later")
+
+    def get_metrics(self):
+        """ Returns the microcli_metrics.MetricsRecorder of the metrics
+            target, or None if metrics are not enabled. """
+        target = os.environ.get(METRICS_ENV_VAR) or self.metrics_target
+        if not target:
+            return None
+        from microcli_metrics import get_recorder
+        return get_recorder(target, self.metrics_flush_interval)
+
+    def record_metrics(self, command_def, exit_status, seconds, output_size):
+        metrics = self.get_metrics()
+        if metrics is not None:
+            metrics.record(
+                self.metrics_prefix or type(self).__name__.lower(),
+                command_def.name, exit_status, seconds, output_size)
+
+    def dispatch(self, arg_list):
+        """ Runs the command named by the first item of arg_list
+            and returns its exit status. """
+        command_def = self.find_command(arg_list)
+        if command_def is None:
+            return 1
+        with CommandInvocation(self, command_def) as invocation:
+            invocation.exit_status = self.run_command(
+                command_def, arg_list[1:])
+        return invocation.exit_status
+
+    def run_command(self, command_def, args):
+        """ Runs the command with args, returns its exit status.
+            microcli_async.run_command is the same, except that it
+            awaits async commands instead of calling run_coroutine. """
+        try:
+            result = command_def.run(self, args)
+            if is_awaitable(result):
+                with PhaseTimer(self, "execute"):
+                    result = self.run_coroutine(result)
+            # generators run while their items are written
+            return self.write_result(result)
+        except Exception as e:
+            return self.handle_error(e)
+
+    def write_result(self, result):
+        """ Writes the value returned by a command,
+            returns the exit status """
+        with PhaseTimer(self, "output"):
+            return self.handle_result(result)
+
+    def find_command(self, arg_list):
+        """ Returns the definition of the command named by the first
+            item of arg_list, or None after reporting why there is none. """
         command_name = self.default_command
-        if self.arg_list:
-            command_name = self.arg_list[0]
+        if arg_list:
+            command_name = arg_list[0]
         if command_name is None:
             self.write(
                 "Please specify a command (try " +
                 "the 'help' command for usage info)!")
-            self.exit(1)
-        if command_name in self.command_definitions:
-            command_def = self.command_definitions[command_name]
-            command_args = self.arg_list[1:]
-            result = None
-            try:
-                result = command_def.run(self, command_args)
-            except Exception as e:
-                import traceback
-                self.write("Error: %s" % str(e))
-                self.write("%s" % traceback.format_exc())
-                self.exit(1)
-            if type(result) == int:
-                self.exit(result)
-            if result is not None:
-                self.write(result)
-                self.exit(0)
+            return None
+        try:
+            return self.resolve_command(command_name)
+        except Exception as e:
+            # eg. the module of a command group can't be imported
+            self.write("Failed to load command '%s'" % command_name)
+            self.handle_error(e)
+            return None
+
+    def resolve_command(self, command_name):
+        """ Returns the definition of the command named (or abbreviated)
+            command_name, or None after reporting why there is none.
+            Raises the errors of loading command groups and plugins. """
+        command_def = self.lookup_command(command_name)
+        if command_def is not None:
+            return command_def
+        index = self.get_command_index()
+        if self.command_abbreviations:
+            lazy_commands = self.get_lazy_commands()
+            completions = [
+                name for name in index.get_completions(command_name, 6)
+                if name in self.command_definitions or name in lazy_commands]
+            if len(completions) == 1:
+                return self.lookup_command(completions[0])
+            if completions:
+                if len(completions) > 5:
+                    completions[5:] = ["..."]
+                self.write("Ambiguous command '%s' (could be %s)!" % (
+                    command_name, ", ".join(completions)))
+                return None
+        self.write((
+            "Unrecognized command '%s' " +
+            "(try the 'help' command for usage info)!") % command_name)
+        suggestions = self.suggest_commands(command_name)
+        if suggestions:
+            self.write("Did you mean %s?" % " or ".join(
+                "'%s'" % name for name in suggestions))
+        return None
+
+    def handle_error(self, error):
+        """ Reports an exception raised by a command,
+            returns the exit status """
+        import traceback
+        self.write("Error: %s" % str(error))
+        self.write("%s" % traceback.format_exc())
+        return 1
+
+    def run_coroutine(self, awaitable):
+        """ Runs the coroutine returned by an async command to completion
+            on the event loop shared by the thread, returns its result. """
+        from microcli_async import run_until_complete
+        return run_until_complete(awaitable)
+
+    def handle_result(self, result):
+        """ Returns the exit status for the value returned by a command """
+        if type(result) == int:
+            return result
+        output_format = (getattr(self, 'global_options', None) or {}).get(
+            'output_format')
+        if output_format is not None and result is not None:
+            return self.write_encoded(result, output_format)
+        if is_iterator(result):
+            return self.write_stream(result)
+        if result is not None:
+            self.write(result)
+        return 0
+
+    def run_pipeline(self, stages, inputs=()):
+        """ Runs each stage (a command line without global options)
+            in this process, passing the objects returned or yielded by a
+            command to the next one (and inputs to the first one). Returns
+            the result of the last command, or 1 if a stage names no
+            command. Integers returned by the other commands are values,
+            not exit statuses. On a running event loop, the result is a
+            coroutine running the stages after the first async one. """
+        result = None
+        for stage_number, stage in enumerate(stages):
+            command_def = self.find_command(stage)
+            if command_def is None:
+                return 1
+            result = command_def.run(self, stage[1:], inputs)
+            if is_awaitable(result):
+                if in_event_loop():
+                    from microcli_async import run_pipeline
+                    return run_pipeline(
+                        self, result, stages[stage_number + 1:])
+                result = self.run_coroutine(result)
+            inputs = get_pipeline_inputs(result)
+        return result
+
+    def run_batch(self, lines, fail_fast=False, jobs=1, processes=False,
+                  ordered=True, event_loop=False):
+        """ Runs each line as a command line (which may include global
+            options) and returns (line number, line, exit status) tuples.
+            Lines are split like a shell would, '#' starts a comment.
+            With jobs > 1, lines run concurrently on a pool of threads
+            (or processes) and the output of each line is written at once
+            when it is done, in the order of the lines if ordered.
+            With event_loop, up to jobs lines run concurrently as
+            coroutines on a single event loop (python 3.5+). """
+        global_options = getattr(self, 'global_options', None)
+        batch_lines = self.iter_batch_lines(lines)
+        if event_loop:
+            if sys.version_info < (3, 5):
+                raise RuntimeError("event_loop requires python 3.5 or later")
+            from microcli_async import run_batch
+            return run_batch(
+                self, batch_lines, global_options, fail_fast, jobs, ordered)
+        if jobs > 1:
+            return self.run_batch_pool(
+                batch_lines, global_options, fail_fast, jobs, processes,
+                ordered)
+        arg_list = getattr(self, 'arg_list', None)
+        results = []
+        try:
+            for line_number, line, args in batch_lines:
+                exit_status = self.run_batch_line(args, global_options)
+                results.append((line_number, line, exit_status))
+                if exit_status != 0 and fail_fast:
+                    break
+        finally:
+            self.global_options, self.arg_list = global_options, arg_list
+        return results
+
+    def iter_batch_lines(self, lines):
+        import shlex
+        for line_number, line in enumerate(lines, 1):
+            args = shlex.split(line, comments=True)
+            if args:
+                yield line_number, line.strip(), args
+
+    def run_batch_pool(self, batch_lines, global_options, fail_fast, jobs,
+                       processes, ordered):
+        if processes:
+            from functools import partial
+            from multiprocessing import Pool
+            pool = Pool(jobs)
+            # workers create their own instance, the class must be picklable
+            make_cli = partial(type(self), [self.argv[0]])
         else:
-            self.write((
-                "Unrecognized command '%s' " +
-                "(try the 'help' command for usage info)!") % command_name)
-            self.exit(1)
-
-
-class MicroCLITestCase(unittest.TestCase):
-
-    RETVAL = 15
-
-    class T(MicroCLI):
-        @command()
-        def f1(self):
-            """simple command: no parameters"""
-            return MicroCLITestCase.RETVAL
-
-        @command()
-        def f2(self, a):
-            """a command with only positional arguments"""
-            return a
-
-        @command()
-        def f3(self, awesome_option="asdf"):
-            """a command with only keyword arguments"""
-            return len(awesome_option)
-
-        @command()
-        def f4(self, arg1, arg2, kwopt="asdf"):
-            """a command with both positional and keyword arguments"""
-            return "%s,%s,%s" % (arg1, arg2, kwopt)
-
-        @command()
-        def f5(self, cmd_specific_arg=2):
-            """a command that uses global options"""
-            return (int(self.global_options['some_option']) +
-                    int(cmd_specific_arg))
-
-        @command()
-        def f6(self, arg1, arg2, *vararg):
-            """a command which accepts varargs"""
-            return "%s,%s,%s" % (arg1, arg2, len(vararg))
-
-        @command()
-        def f7(self, int_option=0, float_option=0.1, bool_option1=True,
-               bool_option2=False, string_option="asdf"):
-            """a command to test the types of kwargs"""
-            return "%s,%s,%s,%s,%s,%s,%s,%s,%s,%s" % (
-                type(int_option).__name__,
-                str(int_option),
-                type(float_option).__name__,
-                str(float_option),
-                type(bool_option1).__name__,
-                str(bool_option1),
-                type(bool_option2).__name__,
-                str(bool_option2),
-                type(string_option).__name__,
-                str(string_option))
-
-        @command(parser_options={'ignore_unknown': True})
-        def f8(self, *option):
-            """command parsers can treat unknown options as varargs"""
-            return " ".join(option)
-
-        @command()
-        def f9(self, arg, switch=2, *vararg):
-            """a command which accepts args, kwargs and varargs"""
-            return "%s,%s,%s" % (len(vararg), switch, arg)
-
-    def __init__(self, *args, **kwargs):
-        super(MicroCLITestCase, self).__init__(*args, **kwargs)
-        # doing import here so these imports are
-        # not dependencies for regular use
-        global patch
-        global StringIO
-        patch = None
-        StringIO = None
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(jobs)
+            make_cli = self.fork
+        tasks = ((make_cli, global_options, batch_line)
+                 for batch_line in batch_lines)
+        imap = pool.imap if ordered else pool.imap_unordered
+        results = []
         try:
-            # python 2
-            from mock import patch
-            from StringIO import StringIO
-        except ImportError:
-            pass
+            for line_number, line, exit_status, output in imap(
+                    run_batch_task, tasks):
+                self.stdout.write(output)
+                results.append((line_number, line, exit_status))
+                if exit_status != 0 and fail_fast:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
+    def fork(self, stdout=None):
+        """ Returns a copy of the instance for running a command
+            independently of this one: it has its own stdout, command
+            definitions and global options, but shares the command specs
+            and the global options registered on the global_optparser. """
+        import copy
+        clone = copy.copy(self)
+        clone.stdout = stdout or self.stdout
+        clone.timings = []
+        if getattr(self, 'global_options', None) is not None:
+            clone.global_options = dict(self.global_options)
+        clone.command_definitions = clone.get_all_command_definitions()
+        clone.lazy_command_definitions = {}
+        clone.global_optparser = copy.copy(self.global_optparser)
+        clone.global_optparser.command_definitions = clone.command_definitions
+        clone.global_optparser.commands_help_writer = clone.write_commands_help
+        clone.global_optparser.stderr = clone.stdout
+        return clone
+
+    def run_batch_line(self, args, global_options=None):
+        # Global options on the line override those of the batch
         try:
-            # python 3
-            from unittest.mock import patch
-            from io import StringIO
-        except ImportError:
-            pass
-        for i in ["patch", "StringIO"]:
-            if globals()[i] is None:
-                sys.stdout.write("Missing dependency for test: %s\n" % i)
-                sys.exit(1)
-
-    def setUp(self):
-        super(MicroCLITestCase, self).setUp()
-
-    def test_command_noargs(self):
-        """exit value is what the command returns if its an int"""
-        with patch("sys.exit") as mock_exit:
-            self.T.main(["script_name", "f1"])
-            mock_exit.assert_called_with(MicroCLITestCase.RETVAL)
-
-    def test_print_returned_string(self):
-        """if the command returns a string it is printed"""
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T("script_name f2 asdf".split())
-            cli.stdout = StringIO()
-            cli.run()
-            self.assertEquals(cli.stdout.getvalue(), "asdf\n")
-            # successful execution exits with code 0
-            mock_exit.assert_called_with(0)
-
-    def test_kwargs_are_optional(self):
-        """kwarg values always have defaults"""
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T("script_name f3".split()).run()
-            # kwargs are optional
-            mock_exit.assert_called_with(4)
-
-    def test_kwargs_are_passed(self):
-        """kwarg values are passed as expected"""
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T(
-                "script_name f3 --awesome-option 1".split()).run()
-            mock_exit.assert_called_with(1)
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T(
-                "script_name f3 --awesome-option 1234567".split()).run()
-            mock_exit.assert_called_with(7)
-
-    def test_mixing_args_and_kwargs(self):
-        """kwarg values can be mixed with arg values"""
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T("script_name f4 --kwopt c a b".split())
-            cli.stdout = StringIO()
-            cli.run()
-            self.assertEquals(cli.stdout.getvalue(), "a,b,c\n")
-            # successful execution exits with code 0
-            mock_exit.assert_called_with(0)
-
-    def test_global_options(self):
-        """test the global option parser"""
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T("script_name --some-option 67 f5".split())
-            cli.global_optparser.add_option(
-                '--some-option',
-                action='store',
-                dest="some_option")
-            cli.run()
-            mock_exit.assert_called_with(67+2)
-
-    def test_mixing_global_and_cmd_options(self):
-        """test the global option parser"""
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T(
-                "script_name --some-option 67 f5 --cmd-specific-arg 13".split())
-            cli.global_optparser.add_option(
-                '--some-option',
-                action='store',
-                dest="some_option")
-            cli.run()
-            mock_exit.assert_called_with(67+13)
-
-    def test_missing_kwarg_value(self):
-        """test what happends when the value of a kwarg is missing"""
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T(
-                "script_name --some-option 67 f5 --cmd-specific-arg".split())
-            cli.global_optparser.add_option(
-                '--some-option',
-                action='store',
-                dest="some_option")
-            cli.run()
-            mock_exit.assert_called_with(1)
-
-    def test_missing_arg(self):
-        """test what happends when not enough
-           arguments are passed to a function"""
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T(["script_name", "f4"])
-            cli.command_definitions["f4"].verify_function_arity(cli, [])
-            mock_exit.assert_called_with(1)
-
-    def test_varargs(self):
-        """varargs are properly passed into the function"""
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T("script_name f6 a b c d e f g h i".split())
-            cli.stdout = StringIO()
-            cli.run()
-            self.assertEquals(cli.stdout.getvalue(), "a,b,7\n")
-            # successful execution exits with code 0
-            mock_exit.assert_called_with(0)
-
-    def test_varargs_with_kwargs(self):
-        """varargs and kwargs can be used together"""
-        with patch("sys.exit") as mock_exit:
-            cli = MicroCLITestCase.T("script_name f9 --switch 3 arg b c d e f g h i".split())
-            cli.stdout = StringIO()
-            cli.run()
-            self.assertEquals(cli.stdout.getvalue(), "8,3,arg\n")
-            # successful execution exits with code 0
-            mock_exit.assert_called_with(0)
-
-    def test_kwarg_type(self):
-        """kwarg values have the type of their default arguments"""
-        with patch.object(MicroCLI, "exit") as mock_exit:
-            cli = MicroCLITestCase.T([
-                "script_name",
-                "f7",
-                "--int-option", "1",
-                "--float-option", "2.5",
-                "--bool-option1",
-                "--bool-option2",
-                "--string-option", "alma"])
-            cli.stdout = StringIO()
-            cli.run()
-            self.assertEquals(
-                cli.stdout.getvalue(),
-                "int,1,float,2.5,bool,False,bool,True,str,alma\n")
-            # successful execution exits with code 0
-            mock_exit.assert_called_with(0)
-
-    def test_help(self):
-        """defined commands appear in the help message"""
-        with patch.object(MicroCLI, "exit") as mock_exit:
-            cli = MicroCLITestCase.T(["script_name", "help"], StringIO())
-            cli.run()
-            output = cli.stdout.getvalue()
-            print output
-            self.assertTrue(output.startswith("Usage: "))
-            # successful execution exits with code 0
-            mock_exit.assert_called_with(0)
-
-    def test_parser_options(self):
-        """parser options can be passed as an argument to @command()"""
-        with patch("sys.exit") as mock_exit:
-            argv = "script_name f8 -a b --c d e f g h i".split()
-            cli = MicroCLITestCase.T(argv, StringIO())
-            cli.run()
-            self.assertEquals(
-                cli.stdout.getvalue(),
-                "%s\n" % " ".join(argv[2:]))
-            # successful execution exits with code 0
-            mock_exit.assert_called_with(0)
-
-    def test_command_vs_global_options(self):
-        """Options following the command name are command options"""
-        with patch.object(MicroCLI, "exit") as mock_exit:
-            # --cmd-specific-arg is both a global and a command option.
-            cli = MicroCLITestCase.T(
-                "script_name --cmd-specific-arg 51 f5 --cmd-specific-arg 53".split())
-            cli.global_optparser.add_option(
-                '--cmd-specific-arg',
-                action='store',
-                dest="some_option")
-            cli.run()
-            mock_exit.assert_called_with(104)
-
-    def test_options_in_usage(self):
-        """Global or command options should only appear
-           in the usage message if they apply."""
-
-        class NoGlobal(MicroCLI):
-
-            @command()
-            def no_kwargs(self):
-                return MicroCLITestCase.RETVAL
-
-            @command()
-            def has_kwargs(self, some_option=2):
-                return MicroCLITestCase.RETVAL
-
-        class HasGlobal(MicroCLI):
-
-            def __init__(self, *args, **kwargs):
-                super(HasGlobal, self).__init__(*args, **kwargs)
-                self.global_optparser.add_option(
-                    '--some-option',
-                    action='store',
-                    dest="some_option")
-
-            @command()
-            def f1(self):
-                return MicroCLITestCase.RETVAL
-
-        with patch("sys.exit") as mock_exit:
-            no_global = NoGlobal(['script_name', '-h'])
-            has_global = HasGlobal(['script_name', '-h'])
-            # Test if [global options] is part of the usage string
-            buf = StringIO()
-            no_global.global_optparser.print_usage(buf)
-            self.assertFalse(GLOBAL_OPTIONS_STR in buf.getvalue())
-            buf = StringIO()
-            has_global.global_optparser.print_usage(buf)
-            self.assertTrue(GLOBAL_OPTIONS_STR in buf.getvalue())
-            self.assertTrue(
-                COMMAND_OPTIONS_STR in
-                no_global.command_definitions['has_kwargs'].
-                opt_parser.formatter.get_command_usage())
-            self.assertFalse(
-                COMMAND_OPTIONS_STR in
-                no_global.command_definitions['no_kwargs'].
-                opt_parser.formatter.get_command_usage())
-
-    # TODO: test unrecognized command
-    # TODO: test default command
-    # TODO: test kwarg types reflected in help
-    # TODO: test error thrown if kwarg command option value has incorrect type
-
-
-def suite():
-    suite = unittest.TestSuite()
-    loader = unittest.TestLoader()
-    suite.addTest(loader.loadTestsFromTestCase(MicroCLITestCase))
-    return suite
-
-if __name__ == "__main__":
-    unittest.main(
-        defaultTest="suite",
-        testRunner=unittest.TextTestRunner(verbosity=2))
+            self.arg_list = self.read_global_options(args, global_options)
+            return self.dispatch(self.arg_list)
+        except SystemExit as e:
+            return get_exit_status(e.code)
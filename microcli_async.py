@@ -0,0 +1,117 @@
+# Support for async def commands (python 3.5+). microcli only imports
+# this module once a command returned a coroutine, or for batches run
+# on an event loop, so it may use syntax python 2 can't parse.
+
+import asyncio
+import threading
+
+from microcli import (CommandInvocation, PhaseTimer, get_exit_status,
+                      get_pipeline_inputs, is_awaitable, new_string_buffer)
+
+thread_state = threading.local()
+
+
+def get_event_loop():
+    """ Returns the event loop shared by all commands run by this thread """
+    loop = getattr(thread_state, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = thread_state.loop = asyncio.new_event_loop()
+    return loop
+
+
+def run_until_complete(awaitable):
+    return get_event_loop().run_until_complete(awaitable)
+
+
+async def dispatch(cli, arg_list):
+    """ Same as MicroCLI.dispatch, but awaits async commands """
+    command_def = cli.find_command(arg_list)
+    if command_def is None:
+        return 1
+    with CommandInvocation(cli, command_def) as invocation:
+        invocation.exit_status = await run_command(
+            cli, command_def, arg_list[1:])
+    return invocation.exit_status
+
+
+async def run_command(cli, command_def, args):
+    try:
+        result = command_def.run(cli, args)
+        if is_awaitable(result):
+            with PhaseTimer(cli, "execute"):
+                result = await result
+        return cli.write_result(result)
+    except Exception as e:
+        return cli.handle_error(e)
+
+
+async def run_pipeline(cli, awaitable, stages):
+    """ Continues MicroCLI.run_pipeline on the running event loop:
+        awaits the result of a stage, then runs the stages after it """
+    result = await awaitable
+    if stages:
+        result = cli.run_pipeline(stages, get_pipeline_inputs(result))
+        if is_awaitable(result):
+            result = await result
+    return result
+
+
+async def run_batch_line(cli, batch_line, global_options):
+    line_number, line, args = batch_line
+    try:
+        cli.arg_list = cli.read_global_options(args, global_options)
+        exit_status = await dispatch(cli, cli.arg_list)
+    except SystemExit as e:
+        exit_status = get_exit_status(e.code)
+    return line_number, line, exit_status, cli.stdout.getvalue()
+
+
+async def run_batch_lines(cli, batch_lines, global_options, fail_fast,
+                          jobs, ordered):
+    # Each line runs on a fork of cli with its own output buffer, at most
+    # jobs of them at a time. If ordered, finished lines wait in
+    # done_lines until all the lines before them are written.
+    batch_lines = enumerate(batch_lines)
+    pending = set()
+    done_lines = {}
+    next_line_ix = 0
+    results = []
+    failed = False
+    while True:
+        while not failed and len(pending) < max(jobs, 1):
+            line_ix, batch_line = next(batch_lines, (None, None))
+            if batch_line is None:
+                break
+            task = asyncio.ensure_future(run_batch_line(
+                cli.fork(new_string_buffer()), batch_line, global_options))
+            task.line_ix = line_ix
+            pending.add(task)
+        if not pending:
+            break
+        done, pending = await asyncio.wait(
+            pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            done_lines[task.line_ix] = task.result()
+            failed = failed or (fail_fast and task.result()[2] != 0)
+        if failed and pending:
+            for task in pending:
+                task.cancel()
+            await asyncio.wait(pending)
+            pending = set()
+        if ordered and not failed:
+            ready_ixs = []
+            while next_line_ix in done_lines:
+                ready_ixs.append(next_line_ix)
+                next_line_ix += 1
+        else:
+            ready_ixs = sorted(done_lines)
+        for line_ix in ready_ixs:
+            line_number, line, exit_status, output = done_lines.pop(line_ix)
+            cli.stdout.write(output)
+            results.append((line_number, line, exit_status))
+    return results
+
+
+def run_batch(cli, batch_lines, global_options, fail_fast, jobs, ordered):
+    return run_until_complete(run_batch_lines(
+        cli, batch_lines, global_options, fail_fast, jobs, ordered))
@@ -0,0 +1,80 @@
+# On-disk store for the results of commands decorated with
+# @command(cache=...), see MicroCLI.call_cached. It is an SQLite database,
+# so any number of processes and threads can use it at the same time.
+# Entries expire after their TTL, and the least recently used entries are
+# evicted once the values take up more than max_size bytes.
+
+import sqlite3
+import time
+from contextlib import closing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    expires REAL,
+    accessed REAL NOT NULL
+)
+"""
+# seconds to wait for other processes holding the database lock
+LOCK_TIMEOUT = 30.0
+
+
+class CommandCache(object):
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        with self.connection:
+            self.connection.execute(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def get(self, key):
+        """ Returns (True, value) if key is in the cache and has not
+            expired, (False, None) otherwise. """
+        now = time.time()
+        with self.connection:
+            with closing(self.connection.cursor()) as cursor:
+                cursor.execute(
+                    "SELECT value FROM entries WHERE key = ? AND "
+                    "(expires IS NULL OR expires > ?)", (key, now))
+                row = cursor.fetchone()
+                if row is None:
+                    return False, None
+                cursor.execute(
+                    "UPDATE entries SET accessed = ? WHERE key = ?",
+                    (now, key))
+        return True, bytes(row[0])
+
+    def set(self, key, value, ttl=None):
+        """ Stores value (bytes) for ttl seconds, forever if ttl is None """
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), len(value), expires, now))
+            self.evict(now)
+
+    def evict(self, now):
+        # called within the transaction of set
+        self.connection.execute(
+            "DELETE FROM entries WHERE expires <= ?", (now,))
+        with closing(self.connection.cursor()) as cursor:
+            cursor.execute("SELECT COALESCE(SUM(size), 0) FROM entries")
+            total_size, = cursor.fetchone()
+            if total_size <= self.max_size:
+                return
+            cursor.execute("SELECT key, size FROM entries ORDER BY accessed")
+            evicted = []
+            for key, size in cursor:
+                if total_size <= self.max_size:
+                    break
+                evicted.append((key,))
+                total_size -= size
+        self.connection.executemany(
+            "DELETE FROM entries WHERE key = ?", evicted)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+# Client for a MicroCLI server (see MicroCLI.serve). It forwards its
+# command line, working directory and environment to the server through
+# a unix domain socket, and relays the output and the exit status of
+# the command. It doesn't import microcli, so it starts as fast as the
+# interpreter does. Usage:
+# microcli_client.py SOCKET_PATH [global options] command [arguments]
+#
+# Protocol: the client sends a JSON object with 'args', 'cwd' and 'env'
+# on a single line, the server answers with frames of a type byte, a
+# 4 byte big endian length and the payload. The last frame is the exit
+# status. When the command first reads stdin, the server sends an empty
+# stdin frame, then the client sends its stdin as is after the request
+# and shuts down its side of the socket at the end of it.
+
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+
+FRAME_STDOUT = b"o"
+FRAME_STDERR = b"e"
+FRAME_EXIT = b"x"
+FRAME_STDIN = b"i"
+FRAME_HEADER = struct.Struct(">cI")
+STDIN_CHUNK_SIZE = 1 << 16
+
+
+def encode_frame(frame_type, payload):
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+
+def get_binary_stream(stream):
+    # python 3 text streams wrap a binary buffer
+    return getattr(stream, 'buffer', stream)
+
+
+def send_stdin(client, stdin):
+    try:
+        fd = stdin.fileno()
+    except (AttributeError, IOError, OSError, ValueError):
+        read = stdin.read  # eg. BytesIO
+    else:
+        # returns what is available, instead of waiting for a full chunk
+        def read(size):
+            return os.read(fd, size)
+    try:
+        while True:
+            data = read(STDIN_CHUNK_SIZE)
+            if not data:
+                break
+            client.sendall(data)
+        client.shutdown(socket.SHUT_WR)
+    except (IOError, OSError, socket.error):
+        pass  # the command finished without reading all of it
+
+
+def call(socket_path, args, stdout=None, stderr=None, stdin=None):
+    """ Runs the command line args on the server, returns the exit status """
+    stdout = stdout or get_binary_stream(sys.stdout)
+    stderr = stderr or get_binary_stream(sys.stderr)
+    stdin = stdin or get_binary_stream(sys.stdin)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+        request = {'args': args, 'cwd': os.getcwd(), 'env': dict(os.environ)}
+        client.sendall(json.dumps(request).encode('utf-8') + b"\n")
+        response = client.makefile('rb')
+        while True:
+            header = response.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                stderr.write(b"Connection to the server was lost\n")
+                return 1
+            frame_type, length = FRAME_HEADER.unpack(header)
+            payload = response.read(length)
+            if frame_type == FRAME_EXIT:
+                return int(payload)
+            if frame_type == FRAME_STDIN:
+                # a daemon thread, as the command may not read all of it
+                sender = threading.Thread(
+                    target=send_stdin, args=(client, stdin))
+                sender.daemon = True
+                sender.start()
+                continue
+            output = stdout if frame_type == FRAME_STDOUT else stderr
+            output.write(payload)
+            output.flush()
+    finally:
+        client.close()
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.stderr.write("Usage: %s socket_path [arguments]\n" % sys.argv[0])
+        sys.exit(2)
+    sys.exit(call(sys.argv[1], sys.argv[2:]))
+
+
+if __name__ == "__main__":
+    main()
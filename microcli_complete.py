@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# Shell completion for MicroCLI tools. The hooks printed by the built-in
+# 'completion' command run this script on every TAB press. It doesn't
+# import microcli or the tool: it answers from the completion index the
+# tool saved (see MicroCLI.save_completion_index), and only runs the tool
+# to rebuild the index when the tool's source changed. Usage:
+# microcli_complete.py INDEX_PATH CWORD WORD...
+# where WORD... is the command line (starting with the program name)
+# and CWORD the index of the word being completed. Prints the
+# candidates, one per line.
+
+# Only modules the interpreter loads on startup anyway: importing
+# json or subprocess would take longer than the rest of a completion.
+import marshal
+import os
+import sys
+
+
+def load_index(index_path):
+    # the index is written by the same interpreter (see the hooks),
+    # so it can be in its marshal format
+    try:
+        with open(index_path, 'rb') as index_file:
+            return marshal.load(index_file)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+
+
+def is_stale(index):
+    for source_file, mtime, size in index['stamp']:
+        try:
+            stat = os.stat(source_file)
+        except OSError:
+            return True
+        if stat.st_mtime != mtime or stat.st_size != size:
+            return True
+    return False
+
+
+def rebuild_index(index, index_path):
+    import subprocess
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(
+            index['rebuild_command'], stdout=devnull, stderr=devnull)
+    return load_index(index_path) or index
+
+
+def complete(index, words, cword):
+    """ Returns the candidates for words[cword] """
+    current = words[cword] if cword < len(words) else ""
+    global_options = index['global_options']
+    command_name = None
+    ix = 1
+    while ix < cword:
+        word = words[ix]
+        if command_name is not None:
+            options = index['commands'].get(command_name, {})
+        else:
+            options = global_options
+        if word.startswith("-") and "=" not in word and options.get(word):
+            if ix + 1 == cword:
+                return []  # the value of an option
+            ix += 1
+        elif command_name is None and not word.startswith("-"):
+            command_name = word
+        ix += 1
+    if command_name is None:
+        if current.startswith("-"):
+            candidates = global_options
+        else:
+            candidates = index['commands']
+    elif current.startswith("-"):
+        candidates = index['commands'].get(command_name, {})
+    else:
+        return []
+    return sorted(name for name in candidates if name.startswith(current))
+
+
+def main():
+    index_path, cword, words = sys.argv[1], int(sys.argv[2]), sys.argv[3:]
+    index = load_index(index_path)
+    if index is None:
+        return
+    if is_stale(index):
+        index = rebuild_index(index, index_path)
+    sys.stdout.write("".join(
+        "%s\n" % candidate for candidate in complete(index, words, cword)))
+
+
+if __name__ == "__main__":
+    main()
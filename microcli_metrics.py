@@ -0,0 +1,168 @@
+# Metrics of command invocations (see MicroCLI.metrics_target): for each
+# command, the number of invocations, their exit statuses, durations and
+# output sizes. Metrics are aggregated in memory and sent to a StatsD
+# server over UDP or appended to a file as JSON lines. Processes running
+# many commands (batches, servers) flush them periodically on a
+# background thread, MicroCLI.run flushes the rest once the command's
+# output is written.
+
+import json
+import os
+import socket
+import threading
+import time
+
+# flushes happen whenever this many samples are waiting
+MAX_PENDING_SAMPLES = 1000
+# upper bounds of the histogram buckets in the metrics file
+DURATION_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+SIZE_BUCKETS = (0, 100, 1000, 10000, 100000, 1000000, 10000000)
+# StatsD packets are kept below the MTU of common networks
+MAX_PACKET_SIZE = 1400
+
+recorders = {}
+recorders_lock = threading.Lock()
+
+
+def get_recorder(target, flush_interval=10.0):
+    """ Returns the recorder of the process for target: 'udp://host:port'
+        for a StatsD server, a file path otherwise. """
+    with recorders_lock:
+        recorder = recorders.get(target)
+        if recorder is None:
+            if target.startswith("udp://"):
+                host, port = target[len("udp://"):].rsplit(":", 1)
+                sink = StatsdSink(host, int(port))
+            else:
+                sink = FileSink(target)
+            recorder = recorders[target] = MetricsRecorder(
+                sink, flush_interval)
+        return recorder
+
+
+def get_histogram(values, buckets):
+    histogram = {}
+    for value in values:
+        bucket = next((str(bound) for bound in buckets if value <= bound),
+                      "inf")
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+    return histogram
+
+
+class StatsdSink(object):
+
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def send(self, counters, samples):
+        lines = ["%s:%d|c" % item for item in sorted(counters.items())]
+        for name, (unit, values) in sorted(samples.items()):
+            # durations are timers, sizes histograms: StatsD aggregates
+            # both into percentiles, but only reports timers as latencies
+            metric_type = "ms" if unit == "ms" else "h"
+            lines.extend(
+                "%s:%g|%s" % (name, value, metric_type) for value in values)
+        packet = []
+        packet_size = 0
+        for line in lines:
+            if packet and packet_size + len(line) + 1 > MAX_PACKET_SIZE:
+                self.send_packet(packet)
+                packet = []
+                packet_size = 0
+            packet.append(line)
+            packet_size += len(line) + 1
+        if packet:
+            self.send_packet(packet)
+
+    def send_packet(self, lines):
+        try:
+            self.socket.sendto("\n".join(lines).encode("utf-8"), self.address)
+        except socket.error:
+            pass  # metrics are best effort
+
+
+class FileSink(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, counters, samples):
+        record = {
+            'time': time.time(),
+            'pid': os.getpid(),
+            'counters': counters,
+            'histograms': dict(
+                (name, get_histogram(
+                    values,
+                    DURATION_BUCKETS_MS if unit == "ms" else SIZE_BUCKETS))
+                for name, (unit, values) in samples.items()),
+        }
+        line = (json.dumps(record, sort_keys=True) + "\n").encode("utf-8")
+        # a single O_APPEND write keeps lines of concurrent processes whole
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+
+class MetricsRecorder(object):
+
+    def __init__(self, sink, flush_interval=10.0):
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.counters = {}
+        # name -> (unit, list of values)
+        self.samples = {}
+        self.pending_samples = 0
+        self.recorded = 0
+        self.flush_thread = None
+
+    def record(self, prefix, command_name, exit_status, seconds, output_size):
+        name = "%s.%s" % (prefix, command_name)
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked (eg. a worker of a batch): the data and the
+                # flush thread belong to the parent
+                self.reset()
+            for counter in ("%s.invocations" % name,
+                            "%s.exit_status.%d" % (name, exit_status)):
+                self.counters[counter] = self.counters.get(counter, 0) + 1
+            self.samples.setdefault(
+                "%s.duration" % name, ("ms", []))[1].append(seconds * 1000.0)
+            self.samples.setdefault(
+                "%s.output_bytes" % name, ("bytes", []))[1].append(output_size)
+            self.pending_samples += 2
+            self.recorded += 1
+            flush_now = self.pending_samples >= MAX_PENDING_SAMPLES
+            # a single command is flushed by MicroCLI.run, only
+            # processes running more of them need the thread
+            if self.recorded == 2 and self.flush_interval:
+                self.flush_thread = threading.Thread(target=self.flush_loop)
+                self.flush_thread.daemon = True
+                self.flush_thread.start()
+        if flush_now:
+            self.flush()
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self.reset()
+            counters, samples = self.counters, self.samples
+            self.counters = {}
+            self.samples = {}
+            self.pending_samples = 0
+        if counters:
+            self.sink.send(counters, samples)
@@ -0,0 +1,113 @@
+# Profilers behind the --profile and --memprofile global options (see
+# GlobalOptionParser.add_profile_options). microcli only imports this
+# module when one of them is given.
+
+import os
+import signal
+import sys
+
+# suffixes of --profile-output files written as collapsed stacks
+COLLAPSED_SUFFIXES = (".collapsed", ".folded")
+# seconds of CPU time between the samples of SamplingProfiler
+SAMPLING_INTERVAL = 0.001
+
+
+class SamplingProfiler(object):
+    """ Records the stack of the main thread every interval seconds of
+        CPU time, and writes the samples as collapsed stacks (one line
+        per stack: frames separated by ';' and the number of samples),
+        the input of flame graph tools. Unix only. """
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stacks = {}
+        self.previous_handler = None
+
+    def enable(self):
+        self.previous_handler = signal.signal(signal.SIGPROF, self.sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def disable(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self.previous_handler or signal.SIG_DFL)
+
+    def sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s:%s" % (
+                os.path.basename(code.co_filename), code.co_name))
+            frame = frame.f_back
+        stack = ";".join(reversed(stack))
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def write_collapsed(self, stream):
+        stream.write("".join(
+            "%s %d\n" % item for item in sorted(self.stacks.items())))
+
+
+class CommandProfiler(object):
+    """ Profiles the CPU time (with cProfile, or SamplingProfiler when the
+        output file is for collapsed stacks) and the memory allocations
+        (with tracemalloc) of the code run between start and stop. """
+
+    def __init__(self, cpu=False, memory=False, output_path=None, top=20):
+        self.output_path = output_path
+        self.top = top
+        self.cpu_profiler = None
+        self.tracemalloc = None
+        self.snapshot = None
+        self.peak = 0
+        self.started = False
+        if cpu or output_path:
+            if output_path and output_path.endswith(COLLAPSED_SUFFIXES):
+                self.cpu_profiler = SamplingProfiler()
+            else:
+                import cProfile
+                self.cpu_profiler = cProfile.Profile()
+        if memory:
+            # raises ImportError before python 3.4
+            import tracemalloc
+            self.tracemalloc = tracemalloc
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        if self.tracemalloc is not None:
+            self.tracemalloc.start()
+        if self.cpu_profiler is not None:
+            self.cpu_profiler.enable()
+
+    def stop(self):
+        if not self.started:
+            return
+        self.started = False
+        if self.cpu_profiler is not None:
+            self.cpu_profiler.disable()
+        if self.tracemalloc is not None:
+            self.snapshot = self.tracemalloc.take_snapshot().filter_traces([
+                self.tracemalloc.Filter(False, self.tracemalloc.__file__)])
+            self.peak = max(self.peak, self.tracemalloc.get_traced_memory()[1])
+            self.tracemalloc.stop()
+
+    def report(self, stream=None):
+        """ Writes the profile to the output file, and the top functions
+            and allocating lines to stream (stderr by default). """
+        stream = stream or sys.stderr
+        if isinstance(self.cpu_profiler, SamplingProfiler):
+            with open(self.output_path, "w") as output:
+                self.cpu_profiler.write_collapsed(output)
+        elif self.cpu_profiler is not None:
+            import pstats
+            if self.output_path:
+                self.cpu_profiler.dump_stats(self.output_path)
+            else:
+                stats = pstats.Stats(self.cpu_profiler, stream=stream)
+                stats.sort_stats("cumulative").print_stats(self.top)
+        if self.snapshot is not None:
+            stream.write("Peak traced memory: %.1f KiB\n" % (
+                self.peak / 1024.0))
+            stream.write("Top %d allocating lines:\n" % self.top)
+            for statistic in self.snapshot.statistics("lineno")[:self.top]:
+                stream.write("%s\n" % statistic)
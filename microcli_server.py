@@ -0,0 +1,194 @@
+# Server keeping a MicroCLI subclass loaded behind a unix domain socket,
+# see MicroCLI.serve. Each request is handled in a child process forked
+# from the server, which skips interpreter startup, imports and command
+# introspection, while keeping requests isolated from each other.
+
+import json
+import os
+import socket
+import sys
+import time
+try:
+    import socketserver
+except ImportError:
+    # python 2
+    import SocketServer as socketserver
+
+from microcli import get_exit_status
+from microcli_client import (FRAME_EXIT, FRAME_STDERR, FRAME_STDIN,
+                             FRAME_STDOUT, encode_frame)
+
+# how often the server checks for idleness and source changes (seconds)
+POLL_INTERVAL = 1.0
+
+
+class ServerRunningError(RuntimeError):
+    """ Raised when another server listens on the socket path """
+    pass
+
+
+def to_native_strings(value):
+    # json gives unicode strings, python 2 wants byte strings
+    if bytes is str and isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [to_native_strings(item) for item in value]
+    if isinstance(value, dict):
+        return dict((to_native_strings(k), to_native_strings(v))
+                    for k, v in value.items())
+    return value
+
+
+class FrameWriter(object):
+    """ File-like object sending what is written to it as frames """
+
+    def __init__(self, wfile, frame_type):
+        self.wfile = wfile
+        self.frame_type = frame_type
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if data:
+            self.wfile.write(encode_frame(self.frame_type, data))
+
+    def flush(self):
+        self.wfile.flush()
+
+    def isatty(self):
+        return False
+
+
+class RemoteStdin(object):
+    """ File-like object reading the stdin of the client. The client only
+        sends it once asked to, when the command first reads it. """
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.requested = False
+
+    def request(self):
+        if not self.requested:
+            self.requested = True
+            self.wfile.write(encode_frame(FRAME_STDIN, b""))
+            self.wfile.flush()
+
+    def to_native_string(self, data):
+        if bytes is str:
+            return data  # python 2
+        # decoded like sys.argv
+        return data.decode(sys.getfilesystemencoding(), 'surrogateescape')
+
+    def read(self, size=-1):
+        self.request()
+        return self.to_native_string(self.rfile.read(size))
+
+    def readline(self):
+        self.request()
+        return self.to_native_string(self.rfile.readline())
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def isatty(self):
+        return False
+
+
+class CommandRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        # This runs in a child process forked for the request, so the
+        # working directory, the environment and sys.std* can be changed.
+        request_line = self.rfile.readline()
+        if not request_line:
+            # eg. another server checking that this one is running
+            return
+        request = to_native_strings(json.loads(request_line.decode('utf-8')))
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        stdout = FrameWriter(self.wfile, FRAME_STDOUT)
+        sys.stdout = stdout
+        sys.stderr = FrameWriter(self.wfile, FRAME_STDERR)
+        exit_status = 0
+        try:
+            stdin = RemoteStdin(self.rfile, self.wfile)
+            sys.stdin = stdin
+            cli = self.server.cli_class(
+                [self.server.script_name] + request['args'], stdout, stdin)
+            cli.run()
+        except SystemExit as e:
+            exit_status = get_exit_status(e.code)
+        except Exception:
+            import traceback
+            sys.stderr.write(traceback.format_exc())
+            exit_status = 1
+        self.wfile.write(
+            encode_frame(FRAME_EXIT, str(exit_status).encode('ascii')))
+        self.wfile.flush()
+
+
+class CommandServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+
+    def __init__(self, socket_path, cli_class, script_name=None,
+                 idle_timeout=None, reload=True):
+        self.socket_path = socket_path
+        self.cli_class = cli_class
+        self.script_name = script_name or os.path.basename(sys.argv[0])
+        self.idle_timeout = idle_timeout
+        self.reload = reload
+        self.remove_stale_socket()
+        # only the owner may connect: requests run with its privileges
+        old_umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.__init__(
+                self, socket_path, CommandRequestHandler)
+        finally:
+            os.umask(old_umask)
+        self.timeout = min(POLL_INTERVAL, idle_timeout or POLL_INTERVAL)
+        self.last_activity = time.time()
+        self.stamp = cli_class.get_manifest_stamp()
+        # forked children inherit the command specs
+        cli_class.get_command_specs()
+
+    def remove_stale_socket(self):
+        if not os.path.exists(self.socket_path):
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except socket.error:
+            os.unlink(self.socket_path)
+        else:
+            raise ServerRunningError(
+                "A server is already listening on %s" % self.socket_path)
+        finally:
+            probe.close()
+
+    def process_request(self, request, client_address):
+        self.last_activity = time.time()
+        socketserver.ForkingMixIn.process_request(
+            self, request, client_address)
+
+    def is_idle(self):
+        return (self.idle_timeout is not None and
+                not self.active_children and
+                time.time() - self.last_activity > self.idle_timeout)
+
+    def serve_until_idle(self):
+        """ Handles requests until the server is idle for idle_timeout
+            seconds or (if reload is set) the source of the CLI changes.
+            Returns True in the latter case. """
+        try:
+            while True:
+                self.handle_request()
+                self.collect_children()
+                if self.reload and \
+                        self.stamp != self.cli_class.get_manifest_stamp():
+                    return True
+                if self.is_idle():
+                    return False
+        finally:
+            self.server_close()
+            os.unlink(self.socket_path)
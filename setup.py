@@ -10,7 +10,9 @@ setup(name="microcli",
       author_email="neumark.peter@gmail.com",
       url="https://github.com/neumark/microcli",
       download_url="https://github.com/neumark/microcli",
-      py_modules=["microcli"],
+      py_modules=["microcli", "microcli_async", "microcli_cache",
+                  "microcli_client", "microcli_complete", "microcli_metrics",
+                  "microcli_profile", "microcli_server"],
       classifiers=[
           "Intended Audience :: Developers",
           "License :: OSI Approved :: Apache Software License",
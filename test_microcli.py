@@ -0,0 +1,1577 @@
+#!/usr/bin/env python
+
+# To run a single test, run eg:
+# python test_microcli.py MicroCLITestCase.test_varargs
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+from microcli import (MicroCLI, command, convert_arg_values,
+                      GLOBAL_OPTIONS_STR, COMMAND_OPTIONS_STR)
+
+
+ASYNC_CLI_SOURCE = """
+class AsyncCLI(MicroCLI):
+
+    @command()
+    async def sleep(self, word, seconds=0.1):
+        await asyncio.sleep(seconds)
+        self.write(word)
+        return len(word)
+
+    @command()
+    async def fail(self):
+        raise ValueError("async failure")
+
+    @command()
+    def show(self, *values):
+        return " ".join(str(value) for value in values)
+"""
+
+
+ANNOTATED_CLI_SOURCE = """
+class AnnotatedCLI(MicroCLI):
+
+    @command()
+    def scale(self, factor: float, *values: int) -> str:
+        return repr((factor, values))
+
+    @command(arg_types={'name': 'path'})
+    def paths(self, name, *paths: pathlib.Path):
+        return " ".join(type(value).__name__ for value in (name,) + paths)
+"""
+
+
+class ParallelCLI(MicroCLI):
+    """ defined at module level so process pools can pickle it """
+
+    def __init__(self, *args, **kwargs):
+        super(ParallelCLI, self).__init__(*args, **kwargs)
+        self.global_optparser.add_option(
+            '--prefix', action='store', dest="prefix", default="")
+
+    @command()
+    def echo(self, *words):
+        for word in words:
+            self.write(self.global_options['prefix'] + word)
+        return int(words[0]) if words[0].isdigit() else 0
+
+
+class MicroCLITestCase(unittest.TestCase):
+
+    RETVAL = 15
+
+    class T(MicroCLI):
+        @command()
+        def f1(self):
+            """simple command: no parameters"""
+            return MicroCLITestCase.RETVAL
+
+        @command()
+        def f2(self, a):
+            """a command with only positional arguments"""
+            return a
+
+        @command()
+        def f3(self, awesome_option="asdf"):
+            """a command with only keyword arguments"""
+            return len(awesome_option)
+
+        @command()
+        def f4(self, arg1, arg2, kwopt="asdf"):
+            """a command with both positional and keyword arguments"""
+            return "%s,%s,%s" % (arg1, arg2, kwopt)
+
+        @command()
+        def f5(self, cmd_specific_arg=2):
+            """a command that uses global options"""
+            return (int(self.global_options['some_option']) +
+                    int(cmd_specific_arg))
+
+        @command()
+        def f6(self, arg1, arg2, *vararg):
+            """a command which accepts varargs"""
+            return "%s,%s,%s" % (arg1, arg2, len(vararg))
+
+        @command()
+        def f7(self, int_option=0, float_option=0.1, bool_option1=True,
+               bool_option2=False, string_option="asdf"):
+            """a command to test the types of kwargs"""
+            return "%s,%s,%s,%s,%s,%s,%s,%s,%s,%s" % (
+                type(int_option).__name__,
+                str(int_option),
+                type(float_option).__name__,
+                str(float_option),
+                type(bool_option1).__name__,
+                str(bool_option1),
+                type(bool_option2).__name__,
+                str(bool_option2),
+                type(string_option).__name__,
+                str(string_option))
+
+        @command(parser_options={'ignore_unknown': True})
+        def f8(self, *option):
+            """command parsers can treat unknown options as varargs"""
+            return " ".join(option)
+
+        @command()
+        def f9(self, arg, switch=2, *vararg):
+            """a command which accepts args, kwargs and varargs"""
+            return "%s,%s,%s" % (len(vararg), switch, arg)
+
+    def __init__(self, *args, **kwargs):
+        super(MicroCLITestCase, self).__init__(*args, **kwargs)
+        # doing import here so these imports are
+        # not dependencies for regular use
+        global patch
+        global StringIO
+        patch = None
+        StringIO = None
+        try:
+            # python 2
+            from mock import patch
+            from StringIO import StringIO
+        except ImportError:
+            pass
+        try:
+            # python 3
+            from unittest.mock import patch
+            from io import StringIO
+        except ImportError:
+            pass
+        for i in ["patch", "StringIO"]:
+            if globals()[i] is None:
+                sys.stdout.write("Missing dependency for test: %s\n" % i)
+                sys.exit(1)
+
+    def setUp(self):
+        super(MicroCLITestCase, self).setUp()
+
+    def test_command_noargs(self):
+        """exit value is what the command returns if its an int"""
+        with patch("sys.exit") as mock_exit:
+            self.T.main(["script_name", "f1"])
+            mock_exit.assert_called_with(MicroCLITestCase.RETVAL)
+
+    def test_print_returned_string(self):
+        """if the command returns a string it is printed"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T("script_name f2 asdf".split())
+            cli.stdout = StringIO()
+            cli.run()
+            self.assertEquals(cli.stdout.getvalue(), "asdf\n")
+            # successful execution exits with code 0
+            mock_exit.assert_called_with(0)
+
+    def test_kwargs_are_optional(self):
+        """kwarg values always have defaults"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T("script_name f3".split()).run()
+            # kwargs are optional
+            mock_exit.assert_called_with(4)
+
+    def test_kwargs_are_passed(self):
+        """kwarg values are passed as expected"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T(
+                "script_name f3 --awesome-option 1".split()).run()
+            mock_exit.assert_called_with(1)
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T(
+                "script_name f3 --awesome-option 1234567".split()).run()
+            mock_exit.assert_called_with(7)
+
+    def test_mixing_args_and_kwargs(self):
+        """kwarg values can be mixed with arg values"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T("script_name f4 --kwopt c a b".split())
+            cli.stdout = StringIO()
+            cli.run()
+            self.assertEquals(cli.stdout.getvalue(), "a,b,c\n")
+            # successful execution exits with code 0
+            mock_exit.assert_called_with(0)
+
+    def test_global_options(self):
+        """test the global option parser"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T("script_name --some-option 67 f5".split())
+            cli.global_optparser.add_option(
+                '--some-option',
+                action='store',
+                dest="some_option")
+            cli.run()
+            mock_exit.assert_called_with(67+2)
+
+    def test_mixing_global_and_cmd_options(self):
+        """test the global option parser"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T(
+                "script_name --some-option 67 f5 --cmd-specific-arg 13".split())
+            cli.global_optparser.add_option(
+                '--some-option',
+                action='store',
+                dest="some_option")
+            cli.run()
+            mock_exit.assert_called_with(67+13)
+
+    def test_missing_kwarg_value(self):
+        """test what happends when the value of a kwarg is missing"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T(
+                "script_name --some-option 67 f5 --cmd-specific-arg".split())
+            cli.global_optparser.add_option(
+                '--some-option',
+                action='store',
+                dest="some_option")
+            cli.run()
+            mock_exit.assert_called_with(1)
+
+    def test_missing_arg(self):
+        """test what happends when not enough
+           arguments are passed to a function"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T(["script_name", "f4"])
+            cli.command_definitions["f4"].verify_function_arity(cli, [])
+            mock_exit.assert_called_with(1)
+
+    def test_varargs(self):
+        """varargs are properly passed into the function"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T("script_name f6 a b c d e f g h i".split())
+            cli.stdout = StringIO()
+            cli.run()
+            self.assertEquals(cli.stdout.getvalue(), "a,b,7\n")
+            # successful execution exits with code 0
+            mock_exit.assert_called_with(0)
+
+    def test_varargs_with_kwargs(self):
+        """varargs and kwargs can be used together"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T("script_name f9 --switch 3 arg b c d e f g h i".split())
+            cli.stdout = StringIO()
+            cli.run()
+            self.assertEquals(cli.stdout.getvalue(), "8,3,arg\n")
+            # successful execution exits with code 0
+            mock_exit.assert_called_with(0)
+
+    def test_kwarg_type(self):
+        """kwarg values have the type of their default arguments"""
+        with patch.object(MicroCLI, "exit") as mock_exit:
+            cli = MicroCLITestCase.T([
+                "script_name",
+                "f7",
+                "--int-option", "1",
+                "--float-option", "2.5",
+                "--bool-option1",
+                "--bool-option2",
+                "--string-option", "alma"])
+            cli.stdout = StringIO()
+            cli.run()
+            self.assertEquals(
+                cli.stdout.getvalue(),
+                "int,1,float,2.5,bool,False,bool,True,str,alma\n")
+            # successful execution exits with code 0
+            mock_exit.assert_called_with(0)
+
+    def test_help(self):
+        """defined commands appear in the help message"""
+        with patch.object(MicroCLI, "exit") as mock_exit:
+            cli = MicroCLITestCase.T(["script_name", "help"], StringIO())
+            cli.run()
+            output = cli.stdout.getvalue()
+            print(output)
+            self.assertTrue(output.startswith("Usage: "))
+            # successful execution exits with code 0
+            mock_exit.assert_called_with(0)
+
+    def test_option_help(self):
+        """options are described by the option_help of @command()"""
+        with patch.object(MicroCLI, "exit") as mock_exit:
+            cli = MicroCLITestCase.T(["script_name", "help"], StringIO())
+            cli.run()
+            output = cli.stdout.getvalue()
+            self.assertTrue(
+                "--fail-fast   Stop at the first line which fails\n"
+                in output)
+            self.assertTrue(
+                "--jobs=JOBS   Number of lines run concurrently, "
+                "type: int (default is 1)\n" in output)
+            mock_exit.assert_called_with(0)
+
+    def test_parser_options(self):
+        """parser options can be passed as an argument to @command()"""
+        with patch("sys.exit") as mock_exit:
+            argv = "script_name f8 -a b --c d e f g h i".split()
+            cli = MicroCLITestCase.T(argv, StringIO())
+            cli.run()
+            self.assertEquals(
+                cli.stdout.getvalue(),
+                "%s\n" % " ".join(argv[2:]))
+            # successful execution exits with code 0
+            mock_exit.assert_called_with(0)
+
+    def test_command_vs_global_options(self):
+        """Options following the command name are command options"""
+        with patch.object(MicroCLI, "exit") as mock_exit:
+            # --cmd-specific-arg is both a global and a command option.
+            cli = MicroCLITestCase.T(
+                "script_name --cmd-specific-arg 51 f5 --cmd-specific-arg 53".split())
+            cli.global_optparser.add_option(
+                '--cmd-specific-arg',
+                action='store',
+                dest="some_option")
+            cli.run()
+            mock_exit.assert_called_with(104)
+
+    def test_options_in_usage(self):
+        """Global or command options should only appear
+           in the usage message if they apply."""
+
+        class NoGlobal(MicroCLI):
+
+            @command()
+            def no_kwargs(self):
+                return MicroCLITestCase.RETVAL
+
+            @command()
+            def has_kwargs(self, some_option=2):
+                return MicroCLITestCase.RETVAL
+
+        class HasGlobal(MicroCLI):
+
+            def __init__(self, *args, **kwargs):
+                super(HasGlobal, self).__init__(*args, **kwargs)
+                self.global_optparser.add_option(
+                    '--some-option',
+                    action='store',
+                    dest="some_option")
+
+            @command()
+            def f1(self):
+                return MicroCLITestCase.RETVAL
+
+        with patch("sys.exit") as mock_exit:
+            no_global = NoGlobal(['script_name', '-h'])
+            has_global = HasGlobal(['script_name', '-h'])
+            # Test if [global options] is part of the usage string
+            buf = StringIO()
+            no_global.global_optparser.print_usage(buf)
+            self.assertFalse(GLOBAL_OPTIONS_STR in buf.getvalue())
+            buf = StringIO()
+            has_global.global_optparser.print_usage(buf)
+            self.assertTrue(GLOBAL_OPTIONS_STR in buf.getvalue())
+            self.assertTrue(
+                COMMAND_OPTIONS_STR in
+                no_global.command_definitions['has_kwargs'].
+                opt_parser.formatter.get_command_usage())
+            self.assertFalse(
+                COMMAND_OPTIONS_STR in
+                no_global.command_definitions['no_kwargs'].
+                opt_parser.formatter.get_command_usage())
+
+    def test_command_specs_are_cached(self):
+        """command specs are computed once per class"""
+
+        class Sub(MicroCLITestCase.T):
+
+            @command()
+            def f10(self):
+                return MicroCLITestCase.RETVAL
+
+        specs = MicroCLITestCase.T.get_command_specs()
+        self.assertTrue(specs is MicroCLITestCase.T.get_command_specs())
+        cli1 = MicroCLITestCase.T(["script_name"])
+        cli2 = MicroCLITestCase.T(["script_name"])
+        self.assertTrue(
+            cli1.command_definitions["f4"].spec is
+            cli2.command_definitions["f4"].spec)
+        self.assertFalse(
+            cli1.command_definitions["f4"].opt_parser is
+            cli2.command_definitions["f4"].opt_parser)
+        # subclasses have their own specs
+        self.assertTrue("f10" in Sub.get_command_specs())
+        self.assertFalse("f10" in specs)
+        self.assertEqual(
+            Sub.get_command_specs()["f4"].args_with_defaults,
+            specs["f4"].args_with_defaults)
+        Sub.f11 = command()(lambda self: MicroCLITestCase.RETVAL)
+        MicroCLITestCase.T.clear_command_specs()
+        self.assertTrue("f11" in Sub.get_command_specs())
+
+    def test_parsers_are_lazy(self):
+        """only the parser of the command which is run gets built"""
+        with patch("sys.exit") as mock_exit:
+            cli = MicroCLITestCase.T("script_name f4 a b".split(), StringIO())
+            cli.run()
+            self.assertEqual(cli.stdout.getvalue(), "a,b,asdf\n")
+            built = [name for name, command_def in
+                     cli.command_definitions.items()
+                     if command_def._opt_parser is not None]
+            self.assertEqual(built, ["f4"])
+
+    def test_import_is_light(self):
+        """importing microcli doesn't import modules
+           which only some code paths need"""
+        deferred = ("unittest", "inspect", "traceback")
+        # some of these are preloaded by the interpreter on startup
+        script = (
+            "import sys; preloaded = set(sys.modules); import microcli; "
+            "sys.stdout.write(' '.join(m for m in %r "
+            "if m in sys.modules and m not in preloaded))" % (deferred,))
+        output = subprocess.check_output(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), b"")
+
+    def test_command_manifest(self):
+        """command specs are stored in and loaded from the manifest"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            class Manifest(MicroCLITestCase.T):
+                command_manifest = os.path.join(tmp_dir, "manifest")
+
+            specs = Manifest.get_command_specs()
+            self.assertTrue(os.path.exists(Manifest.command_manifest))
+            Manifest.clear_command_specs()
+            with patch.object(Manifest, "get_command_spec") as mock_spec:
+                loaded = Manifest.get_command_specs()
+                self.assertFalse(mock_spec.called)
+            self.assertEqual(sorted(loaded.keys()), sorted(specs.keys()))
+            for name, spec in specs.items():
+                self.assertEqual(
+                    loaded[name].args_with_defaults, spec.args_with_defaults)
+                self.assertEqual(loaded[name].varargs, spec.varargs)
+                self.assertEqual(loaded[name].doc, spec.doc)
+            with patch("sys.exit") as mock_exit:
+                cli = Manifest("script_name f4 --kwopt 3 a b".split())
+                cli.stdout = StringIO()
+                cli.run()
+                self.assertEqual(cli.stdout.getvalue(), "a,b,3\n")
+            # a manifest with a different stamp is rebuilt
+            Manifest.clear_command_specs()
+            with patch.object(Manifest, "get_manifest_stamp",
+                              return_value=("changed",)):
+                self.assertEqual(Manifest.load_command_manifest(), None)
+                Manifest.get_command_specs()
+                Manifest.clear_command_specs()
+                self.assertNotEqual(Manifest.load_command_manifest(), None)
+            # subclasses inheriting the path keep their own manifest
+
+            class First(Manifest):
+                pass
+
+            class Second(Manifest):
+                @command()
+                def extra(self):
+                    return "extra"
+
+            for cls in [Manifest, First, Second, Second]:
+                cls.clear_command_specs()
+                self.assertEqual(
+                    "extra" in cls.get_command_specs(), cls is Second)
+            self.assertNotEqual(First.get_command_manifest_path(),
+                                Second.get_command_manifest_path())
+            self.assertNotEqual(Second.load_command_manifest(), None)
+            # a manifest written by another class is rejected
+            shutil.copy(First.get_command_manifest_path(),
+                        Second.get_command_manifest_path())
+            self.assertEqual(Second.load_command_manifest(), None)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_native_option_parser(self):
+        """the native parser engine gives the same results as optparse"""
+
+        class Optparse(MicroCLITestCase.T):
+            @command(parser_options={'ignore_unknown': True})
+            def f10(self, i=1, *args):
+                return "%s,%s" % (i, args)
+
+        class Native(Optparse):
+            native_option_parser = True
+
+        argvs = [
+            "script_name f4 --kwopt c a b",
+            "script_name f4 a --kwopt=c b",
+            "script_name f4 a b -- --kwopt",
+            "script_name f4 --kw c a b",
+            "script_name f4 --kwopt",
+            "script_name f7 --int-option 12 --float-option 1e3 --bool-option1",
+            "script_name f7 --int-option 0x1f",
+            "script_name f7 --int-option abc",
+            "script_name f7 --bool-option2=yes",
+            "script_name f8 -a b --c=d e",
+            # parsers ignoring unknown options keep parsing after "--"
+            "script_name f8 0 -- --",
+            "script_name f10 0 -- --",
+            "script_name f10 a -- --i=3 b",
+            "script_name f10 --i 2 -- -- --i=3",
+            "script_name f9 --switch 3 arg b c",
+            "script_name --some-option 3 f5 --cmd-specific-arg 4",
+            "script_name --some-option=3 --unknown f5",
+            "script_name -h"]
+
+        def run(cls, argv):
+            with patch("sys.exit") as mock_exit:
+                cli = cls(argv.split(), StringIO())
+                cli.global_optparser.add_option(
+                    '--some-option', action='store', type="int",
+                    dest="some_option", default=1)
+                cli.run()
+                return cli.stdout.getvalue(), mock_exit.call_args_list
+
+        for argv in argvs:
+            self.assertEqual(run(Optparse, argv), run(Native, argv))
+        # optparse isn't used for options the native engine understands
+        with patch("sys.exit") as mock_exit:
+            cli = Native("script_name f4 --kwopt c a b".split(), StringIO())
+            cli.run()
+            self.assertEqual(cli.stdout.getvalue(), "a,b,c\n")
+            self.assertEqual(cli.command_definitions["f4"]._opt_parser, None)
+
+        # customized options are read from the parser
+        class Customized(Native):
+            @classmethod
+            def get_parser_option_kwargs(cls, arg_name, default_value):
+                kwargs = super(Customized, cls).get_parser_option_kwargs(
+                    arg_name, default_value)
+                kwargs.pop('type', None)
+                return kwargs
+        argv = "script_name f7 --int-option 12"
+        self.assertEqual(
+            run(Customized, argv)[0], "str,12,float,0.1,bool,True,bool,"
+            "False,str,asdf\n")
+
+    def test_varargs_order(self):
+        """positional args keep their order around options"""
+        with patch("sys.exit") as mock_exit:
+            argv = "script_name f8 a b -c d e --f g h -- -i j".split()
+            cli = MicroCLITestCase.T(argv, StringIO())
+            cli.run()
+            self.assertEqual(
+                cli.stdout.getvalue(), "a b -c d e --f g h -i j\n")
+        cli = MicroCLITestCase.T(["script_name"])
+        self.assertEqual(
+            cli.command_definitions["f9"].combine_args(
+                cli, ["a", "b", "c"], {"switch": 5}),
+            ["a", 5, "b", "c"])
+        args = [str(i) for i in range(100000)]
+        self.assertTrue(
+            cli.command_definitions["f6"].combine_args(cli, args, {}) is args)
+
+    def test_stream_varargs(self):
+        """varargs can be streamed from response files and stdin"""
+        import microcli
+
+        class Stream(MicroCLI):
+
+            @command(stream_varargs=True)
+            def count(self, first, sep=",", *rest):
+                rest, = rest
+                self.write(type(rest).__name__)
+                return sep.join([first, str(sum(1 for _ in rest))])
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            response_file = os.path.join(tmp_dir, "args")
+            with open(response_file, "w") as f:
+                f.write("a\nb\r\n\nc\n")
+            for mmap_size in (microcli.RESPONSE_FILE_MMAP_SIZE, 0):
+                with patch("sys.exit") as mock_exit, \
+                        patch.object(microcli, "RESPONSE_FILE_MMAP_SIZE",
+                                     mmap_size):
+                    argv = ["script_name", "count", "@" + response_file,
+                            "x", "-", "--sep", ";"]
+                    cli = Stream(argv, StringIO(), StringIO("y\nz\n"))
+                    cli.run()
+                    self.assertEqual(
+                        cli.stdout.getvalue(), "generator\na;5\n")
+            # the required args can't be missing from the stream
+            with patch("sys.exit", side_effect=SystemExit) as mock_exit:
+                cli = Stream(["script_name", "count", "-"],
+                             StringIO(), StringIO(""))
+                self.assertRaises(
+                    SystemExit,
+                    cli.command_definitions["count"].run, cli, ["-"])
+                mock_exit.assert_called_with(1)
+                self.assertTrue(
+                    cli.stdout.getvalue().startswith(
+                        "Expected at least 1 arguments, got 0"))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_batch(self):
+        """batch runs every command line of a script"""
+        script = "\n".join([
+            "f2 'a b'",
+            "# comment",
+            "",
+            "f3 --awesome-option ab",
+            "f1",
+            "no_such_command",
+            "f4 x y  # trailing comment"])
+        with patch.object(MicroCLI, "exit") as mock_exit:
+            cli = MicroCLITestCase.T(
+                ["script_name", "batch", "-"], StringIO(), StringIO(script))
+            cli.run()
+            self.assertEqual(cli.stdout.getvalue(), "\n".join([
+                "a b",
+                "Unrecognized command 'no_such_command' "
+                "(try the 'help' command for usage info)!",
+                "x,y,asdf",
+                "line 4: exit status 2: f3 --awesome-option ab",
+                "line 5: exit status 15: f1",
+                "line 6: exit status 1: no_such_command",
+                "5 commands, 3 failed\n"]))
+            mock_exit.assert_called_once_with(1)
+        cli = MicroCLITestCase.T(["script_name"], StringIO())
+        cli.run_batch(["f1"])
+        self.assertEqual(
+            cli.run_batch(["f2 a", "f3", "f2 b"], fail_fast=True),
+            [(1, "f2 a", 0), (2, "f3", 4)])
+        self.assertEqual(cli.stdout.getvalue(), "a\n")
+
+    def test_parallel_batch(self):
+        """batch lines can run on a pool of threads or processes"""
+        script = ["echo a b c", "--prefix x echo d e", "echo 3 f", "echo g"]
+        for processes in (False, True):
+            cli = ParallelCLI(
+                ["script_name", "--prefix", "p", "batch", "-"], StringIO())
+            cli.read_global_options()
+            results = cli.run_batch(script, jobs=3, processes=processes)
+            self.assertEqual(results, [
+                (1, "echo a b c", 0),
+                (2, "--prefix x echo d e", 0),
+                (3, "echo 3 f", 3),
+                (4, "echo g", 0)])
+            self.assertEqual(
+                cli.stdout.getvalue(), "pa\npb\npc\nxd\nxe\np3\npf\npg\n")
+            self.assertEqual(cli.global_options['prefix'], "p")
+        cli = ParallelCLI(["script_name"], StringIO())
+        results = cli.run_batch(script * 10, jobs=4, ordered=False)
+        self.assertEqual(
+            sorted(results), sorted(cli.run_batch(script * 10)))
+        output = cli.stdout.getvalue().split("\n")
+        self.assertEqual(output.count("a"), 20)
+        # the output of a line is never interleaved with another's
+        for line_ix, output_line in enumerate(output):
+            if output_line == "d":
+                self.assertEqual(output[line_ix + 1], "e")
+        results = cli.run_batch(script * 10, jobs=2, fail_fast=True)
+        self.assertEqual(results[-1][2], 3)
+        self.assertTrue(len(results) < 40)
+
+    def test_server(self):
+        """commands can be run through a server process"""
+        from io import BytesIO
+        from microcli_client import call
+        from microcli_server import CommandServer
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            socket_path = os.path.join(tmp_dir, "socket")
+            server = CommandServer(
+                socket_path, ParallelCLI, "tool", idle_timeout=0.2)
+            thread = threading.Thread(target=server.serve_until_idle)
+            thread.start()
+            try:
+                for args, output, exit_status in [
+                        (["--prefix", "x", "echo", "a", "b"], b"xa\nxb\n", 0),
+                        (["echo", "5"], b"5\n", 5),
+                        (["nope"], b"Unrecognized command 'nope' "
+                                   b"(try the 'help' command "
+                                   b"for usage info)!\n",
+                         1),
+                        # stdin is forwarded to the command
+                        (["batch", "--quiet", "-"], b"c\nd\n", 0)]:
+                    stdout = BytesIO()
+                    self.assertEqual(
+                        call(socket_path, args, stdout, BytesIO(),
+                             BytesIO(b"echo c\necho d\n")),
+                        exit_status)
+                    self.assertEqual(stdout.getvalue(), output)
+            finally:
+                thread.join()
+            # the server stops and cleans up when idle
+            self.assertFalse(os.path.exists(socket_path))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_server_env_var_with_arguments(self):
+        """tools run with arguments ignore their serve_env_var"""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            socket_path = os.path.join(tmp_dir, "socket")
+            env = dict(os.environ, CALCULATOR_SERVE=socket_path)
+            directory = os.path.dirname(os.path.abspath(__file__))
+            process = subprocess.Popen(
+                [sys.executable, "example.py", "add", "1", "2"],
+                cwd=directory, env=env, stdout=subprocess.PIPE)
+            timer = threading.Timer(10, process.kill)
+            timer.start()
+            try:
+                output = process.communicate()[0]
+            finally:
+                timer.cancel()
+            self.assertEqual(process.returncode, 0)
+            self.assertEqual(output, b"3\n")
+            self.assertFalse(os.path.exists(socket_path))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_server_env_var_opt_in(self):
+        """only tools setting serve_env_var serve, and report a busy socket"""
+        import socket
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            socket_path = os.path.join(tmp_dir, "socket")
+            env = {'MICROCLI_SERVE': socket_path, 'TOOL_SERVE': socket_path}
+            stdout = StringIO()
+            with patch.dict(os.environ, env), \
+                    patch("sys.argv", ["tool"]), \
+                    patch("sys.exit") as mock_exit, \
+                    patch("sys.stdout", stdout):
+                ParallelCLI.main()
+            # run as usual: without a command
+            mock_exit.assert_called_with(1)
+            self.assertTrue(stdout.getvalue().startswith(
+                "Please specify a command"))
+            self.assertFalse(os.path.exists(socket_path))
+
+            class Tool(ParallelCLI):
+                serve_env_var = "TOOL_SERVE"
+
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                listener.bind(socket_path)
+                listener.listen(1)
+                stderr = StringIO()
+                with patch.dict(os.environ, env), \
+                        patch("sys.argv", ["tool"]), \
+                        patch("sys.exit") as mock_exit, \
+                        patch("sys.stderr", stderr):
+                    Tool.main()
+                mock_exit.assert_called_with(1)
+                self.assertEqual(
+                    stderr.getvalue(),
+                    "A server is already listening on %s\n" % socket_path)
+            finally:
+                listener.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipIf(sys.version_info < (3, 5), "async def needs python 3.5")
+    def test_async_commands(self):
+        """async def commands are run on an event loop"""
+        import asyncio
+        import time
+        namespace = {'MicroCLI': MicroCLI, 'command': command,
+                     'asyncio': asyncio}
+        exec(ASYNC_CLI_SOURCE, namespace)
+        AsyncCLI = namespace['AsyncCLI']
+        with patch("sys.exit") as mock_exit:
+            cli = AsyncCLI("script_name sleep abc --seconds 0".split(),
+                           StringIO())
+            cli.run()
+            self.assertEqual(cli.stdout.getvalue(), "abc\n")
+            mock_exit.assert_called_with(3)
+            cli = AsyncCLI("script_name fail".split(), StringIO())
+            cli.run()
+            self.assertTrue(
+                cli.stdout.getvalue().startswith("Error: async failure"))
+            mock_exit.assert_called_with(1)
+        # batch lines run concurrently on a single event loop
+        cli = AsyncCLI(["script_name"], StringIO())
+        phases = []
+        cli.timing_callbacks.append(
+            lambda phase, seconds: phases.append(phase))
+        script = ["sleep w%d --seconds %s" % (i, 0.2 - i * 0.02)
+                  for i in range(10)]
+        start = time.time()
+        results = cli.run_batch(script, jobs=10, event_loop=True)
+        self.assertTrue(time.time() - start < 1)
+        # the lines are timed like commands run by dispatch, execute
+        # when the coroutine is created and while it is awaited
+        self.assertEqual(
+            [phases.count(phase) for phase in ("parse", "execute", "output")],
+            [10, 20, 10])
+        self.assertEqual([r[2] for r in results], [2] * 10)
+        self.assertEqual(
+            cli.stdout.getvalue(), "".join("w%d\n" % i for i in range(10)))
+        cli = AsyncCLI(["script_name"], StringIO())
+        results = cli.run_batch(
+            script + ["fail"], jobs=3, event_loop=True, ordered=False)
+        self.assertEqual(
+            sorted(r[0] for r in results), list(range(1, 12)))
+        self.assertEqual(cli.stdout.getvalue().split("\n")[0], "w2")
+        # async stages of pipes and commands of groups are awaited
+        import types
+        group_module = types.ModuleType("async_group")
+        group_module.AsyncCLI = AsyncCLI
+        sys.modules["async_group"] = group_module
+        try:
+            class Outer(AsyncCLI):
+                command_groups = {'inner': 'async_group:AsyncCLI'}
+            cli = Outer(["script_name"], StringIO())
+            results = cli.run_batch(
+                ["pipe sleep abc --seconds 0 then show",
+                 "inner sleep xy --seconds 0"], event_loop=True)
+            self.assertEqual([r[2] for r in results], [0, 2])
+            self.assertEqual(cli.stdout.getvalue(), "abc\n3\nxy\n")
+        finally:
+            del sys.modules["async_group"]
+
+    def test_generator_results(self):
+        """items yielded by a command are written as they are produced"""
+        import errno
+        import time
+        from microcli import EXIT_STATUS_BROKEN_PIPE
+
+        class RecordingStream(object):
+
+            def __init__(self, fail_after=None):
+                self.writes = []
+                self.fail_after = fail_after
+
+            def write(self, data):
+                if len(self.writes) == self.fail_after:
+                    raise IOError(errno.EPIPE, "Broken pipe")
+                self.writes.append(data)
+
+        produced = []
+
+        class Streaming(MicroCLI):
+            output_flush_policy = "size"
+            output_flush_size = 4
+
+            @command()
+            def numbers(self, count):
+                try:
+                    for i in range(int(count)):
+                        produced.append(i)
+                        yield i
+                finally:
+                    produced.append("closed")
+
+        with patch("sys.exit") as mock_exit:
+            stream = RecordingStream()
+            Streaming("script_name numbers 5".split(), stream).run()
+            self.assertEqual(stream.writes, ["0\n1\n", "2\n3\n", "4\n"])
+            mock_exit.assert_called_with(0)
+            Streaming.output_flush_policy = "line"
+            stream = RecordingStream()
+            Streaming("script_name numbers 3".split(), stream).run()
+            self.assertEqual(stream.writes, ["0\n", "1\n", "2\n"])
+            # the reader going away stops the command
+            del produced[:]
+            stream = RecordingStream(fail_after=2)
+            Streaming("script_name numbers 1000".split(), stream).run()
+            self.assertEqual(produced, [0, 1, 2, "closed"])
+            mock_exit.assert_called_with(EXIT_STATUS_BROKEN_PIPE)
+
+        # the 'time' policy flushes items while the command is blocked
+        resume = threading.Event()
+
+        class Blocking(MicroCLI):
+            output_flush_policy = "time"
+            output_flush_interval = 0.05
+
+            @command()
+            def wait(self):
+                yield "ready"
+                resume.wait(5)
+                yield "done"
+
+        stream = RecordingStream()
+        cli = Blocking("script_name wait".split(), stream)
+        thread = threading.Thread(target=cli.write_stream, args=(cli.wait(),))
+        thread.start()
+        for _ in range(100):
+            if stream.writes:
+                break
+            time.sleep(0.01)
+        self.assertEqual(stream.writes, ["ready\n"])
+        resume.set()
+        thread.join()
+        self.assertEqual(stream.writes, ["ready\n", "done\n"])
+
+    def test_failing_generator(self):
+        """errors raised by a generator while its items are written are
+        reported after the items, and fail only that command"""
+
+        class Failing(MicroCLI):
+
+            @command()
+            def fail(self):
+                yield 1
+                raise ValueError("failed after 1")
+
+            @command()
+            def ok(self):
+                return "ok"
+
+        with patch("sys.exit") as mock_exit:
+            cli = Failing("script_name fail".split(), StringIO())
+            cli.run()
+            mock_exit.assert_called_with(1)
+            self.assertTrue(cli.stdout.getvalue().startswith(
+                "1\nError: failed after 1\n"))
+        cli = Failing(["script_name"], StringIO())
+        self.assertEqual(cli.run_batch(["fail", "ok"]),
+                         [(1, "fail", 1), (2, "ok", 0)])
+        output = cli.stdout.getvalue()
+        self.assertTrue(output.startswith("1\nError: failed after 1\n"))
+        self.assertTrue(output.endswith("ok\n"))
+
+    def test_output_format(self):
+        """--output-format encodes results as records"""
+        import io
+        import struct
+
+        class Records(MicroCLI):
+
+            def __init__(self, *args, **kwargs):
+                super(Records, self).__init__(*args, **kwargs)
+                self.global_optparser.add_output_format_option(
+                    self.output_encoders)
+
+            @command()
+            def rows(self):
+                for i in range(3):
+                    yield [i, "row %d" % i]
+
+            @command()
+            def table(self):
+                return [{"n": 1}, {"n": 2}]
+
+            @command()
+            def single(self):
+                return "a\tb"
+
+        def run(args):
+            stdout = io.BytesIO()
+            Records(("script_name %s" % args).split(), stdout).run()
+            return stdout.getvalue()
+
+        with patch("sys.exit") as mock_exit:
+            self.assertEqual(
+                run("--output-format jsonl rows").splitlines(),
+                [b'[0,"row 0"]', b'[1,"row 1"]', b'[2,"row 2"]'])
+            mock_exit.assert_called_with(0)
+            self.assertEqual(
+                run("--output-format csv rows"),
+                b"0,row 0\n1,row 1\n2,row 2\n")
+            self.assertEqual(run("--output-format csv table"), b"n\n1\n2\n")
+            self.assertEqual(
+                run("--output-format tsv single"), b'"a\tb"\n')
+            self.assertEqual(
+                run("--output-format binary single"),
+                struct.pack(">I", 3) + b"a\tb")
+            mock_exit.assert_called_with(0)
+            # batch lines write to text buffers
+            stdout = StringIO()
+            Records(
+                "script_name --output-format jsonl batch --jobs 2 --quiet -"
+                .split(), stdout, StringIO("table\nsingle\n")).run()
+            self.assertEqual(
+                stdout.getvalue(), '{"n":1}\n{"n":2}\n"a\\tb"\n')
+            mock_exit.assert_called_with(0)
+
+    def test_pipe(self):
+        """commands in a pipe receive the objects of the previous one"""
+
+        class Pipeline(MicroCLI):
+
+            @command()
+            def numbers(self, count):
+                return iter(range(int(count)))
+
+            @command()
+            def scale(self, factor=1, *xs):
+                return [int(factor) * x for x in xs]
+
+            @command(stream_varargs=True)
+            def total(self, *xs):
+                xs, = xs
+                return sum(int(x) for x in xs)
+
+            @command()
+            def show(self, *xs):
+                return " ".join(repr(x) for x in xs)
+
+        with patch("sys.exit") as mock_exit:
+            stdout = StringIO()
+            Pipeline(
+                ("script_name pipe numbers 4 then scale --factor 3 " +
+                 "then show").split(), stdout).run()
+            self.assertEqual(stdout.getvalue(), "0 3 6 9\n")
+            mock_exit.assert_called_with(0)
+            # arguments on the command line come first
+            stdout = StringIO()
+            Pipeline(
+                ("script_name pipe numbers 4 then total 10 then show " +
+                 "a").split(), stdout).run()
+            self.assertEqual(stdout.getvalue(), "'a' 16\n")
+            stdout = StringIO()
+            Pipeline(
+                "script_name pipe numbers 4 then nonexistent".split(),
+                stdout).run()
+            mock_exit.assert_called_with(1)
+
+    def test_command_cache(self):
+        """results of cached commands are reused"""
+        from microcli_cache import CommandCache
+        calls = []
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        class Cached(MicroCLI):
+            command_cache_path = os.path.join(directory, "cache.sqlite")
+
+            @command(cache=True)
+            def lookup(self, key, suffix=""):
+                calls.append(key)
+                return key.upper() + suffix
+
+            @command(cache={'ttl': 0})
+            def expired(self, key):
+                calls.append(key)
+                return key
+
+        with patch("sys.exit") as mock_exit:
+            for args in ["lookup a", "lookup a", "lookup b",
+                         "lookup --suffix=! a", "lookup a"]:
+                stdout = StringIO()
+                Cached(("script_name %s" % args).split(), stdout).run()
+                mock_exit.assert_called_with(0)
+            self.assertEqual(stdout.getvalue(), "A\n")
+            self.assertEqual(calls, ["a", "b", "a"])
+            Cached("script_name expired c".split(), StringIO()).run()
+            Cached("script_name expired c".split(), StringIO()).run()
+            self.assertEqual(calls, ["a", "b", "a", "c", "c"])
+        # least recently used entries are evicted beyond the size limit
+        cache = CommandCache(os.path.join(directory, "lru.sqlite"), 10)
+        cache.set("a", b"1234")
+        cache.set("b", b"1234")
+        self.assertEqual(cache.get("a"), (True, b"1234"))
+        cache.set("c", b"1234")
+        self.assertEqual(cache.get("b"), (False, None))
+        self.assertEqual(cache.get("a"), (True, b"1234"))
+        self.assertEqual(cache.get("c"), (True, b"1234"))
+        cache.close()
+        # classes sharing the cache don't share results
+
+        class CachedA(Cached):
+            @command(cache=True)
+            def lookup(self, key):
+                return "A:" + key
+
+        class CachedB(Cached):
+            @command(cache=True)
+            def lookup(self, key):
+                return "B:" + key
+
+        with patch("sys.exit"):
+            for cls, output in [(CachedA, "A:q\n"), (CachedB, "B:q\n")]:
+                stdout = StringIO()
+                cls("script_name lookup q".split(), stdout).run()
+                self.assertEqual(stdout.getvalue(), output)
+        # streamed args can't be part of the key
+        self.assertRaises(
+            ValueError, command, stream_varargs=True, cache=True)
+
+    def test_timings(self):
+        """the phases of an invocation are timed"""
+        recorded = []
+
+        class Timed(MicroCLI):
+
+            def __init__(self, *args, **kwargs):
+                super(Timed, self).__init__(*args, **kwargs)
+                self.global_optparser.add_timings_option()
+                self.timing_callbacks.append(
+                    lambda phase, seconds: recorded.append(phase))
+
+            @command()
+            def noop(self, value=None):
+                return "done"
+
+        with patch("sys.exit") as mock_exit:
+            with patch("sys.stderr", new_callable=StringIO) as stderr:
+                cli = Timed(
+                    "script_name --timings noop --value 1".split(),
+                    StringIO())
+                cli.run()
+            mock_exit.assert_called_with(0)
+        self.assertEqual(
+            recorded, ["global_options", "parse", "execute", "output"])
+        self.assertEqual(
+            [phase for phase, seconds in cli.timings],
+            ["introspection"] + recorded)
+        self.assertTrue(all(seconds >= 0 for phase, seconds in cli.timings))
+        self.assertEqual(
+            [line.split()[0] for line in stderr.getvalue().splitlines()],
+            ["introspection"] + recorded)
+
+    def test_profile(self):
+        """--profile reports the functions called by the command"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        def busy_function(n):
+            return sum(i * i for i in range(n))
+
+        class Profiled(MicroCLI):
+
+            def __init__(self, *args, **kwargs):
+                super(Profiled, self).__init__(*args, **kwargs)
+                self.global_optparser.add_profile_options()
+
+            @command()
+            def busy(self):
+                return str(busy_function(200000))
+
+        with patch("sys.exit") as mock_exit:
+            with patch("sys.stderr", new_callable=StringIO) as stderr:
+                Profiled("script_name --profile busy".split(),
+                         StringIO()).run()
+            mock_exit.assert_called_with(0)
+            self.assertTrue("busy_function" in stderr.getvalue())
+            collapsed = os.path.join(directory, "busy.collapsed")
+            Profiled(
+                ["script_name", "--profile-output", collapsed, "busy"],
+                StringIO()).run()
+            mock_exit.assert_called_with(0)
+            with open(collapsed) as collapsed_file:
+                stacks = collapsed_file.read().splitlines()
+            self.assertTrue(stacks)
+            self.assertTrue(all(
+                line.rsplit(" ", 1)[1].isdigit() for line in stacks))
+            if sys.version_info >= (3, 4):
+                with patch("sys.stderr", new_callable=StringIO) as stderr:
+                    Profiled(
+                        "script_name --memprofile busy".split(),
+                        StringIO()).run()
+                self.assertTrue("Peak traced memory" in stderr.getvalue())
+
+    def test_metrics(self):
+        """invocations are counted in the metrics file"""
+        import json
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics_path = os.path.join(directory, "metrics.jsonl")
+
+        class Measured(MicroCLI):
+            metrics_target = metrics_path
+            metrics_flush_interval = 0
+
+            @command()
+            def ok(self):
+                return "fine"
+
+            @command()
+            def fail(self):
+                return 3
+
+        with patch("sys.exit") as mock_exit:
+            Measured("script_name ok".split(), StringIO()).run()
+            Measured("script_name fail".split(), StringIO()).run()
+            mock_exit.assert_called_with(3)
+        # usage errors exit the interpreter, they are counted too
+        with self.assertRaises(SystemExit):
+            Measured("script_name ok extra".split(), StringIO()).run()
+        with open(metrics_path) as metrics_file:
+            records = [json.loads(line) for line in metrics_file]
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[0]['counters'], {
+            "measured.ok.invocations": 1,
+            "measured.ok.exit_status.0": 1})
+        self.assertEqual(
+            records[0]['histograms']["measured.ok.output_bytes"],
+            {"100": 1})
+        self.assertEqual(records[1]['counters'], {
+            "measured.fail.invocations": 1,
+            "measured.fail.exit_status.3": 1})
+        self.assertEqual(
+            sum(records[1]['histograms']["measured.fail.duration"].values()),
+            1)
+        self.assertEqual(records[2]['counters'], {
+            "measured.ok.invocations": 1,
+            "measured.ok.exit_status.1": 1})
+        # StatsD gets sizes as histograms, not timers
+        from microcli_metrics import StatsdSink
+        sink = StatsdSink("localhost", 8125)
+        self.addCleanup(sink.socket.close)
+        with patch.object(sink, "send_packet") as send_packet:
+            sink.send({}, {"t.ok.duration": ("ms", [1.5]),
+                           "t.ok.output_bytes": ("bytes", [5])})
+        send_packet.assert_called_with(
+            ["t.ok.duration:1.5|ms", "t.ok.output_bytes:5|h"])
+
+    def test_shared_command_metadata(self):
+        """commands with identical signatures share their metadata"""
+
+        class Shared(MicroCLI):
+
+            @command()
+            def first(self, name, count=1):
+                pass
+
+            @command()
+            def second(self, name, count=1):
+                pass
+
+            @command()
+            def third(self, name, count=True):
+                pass
+
+        cli = Shared(["script_name"])
+        first, second, third = [
+            cli.command_definitions[name]
+            for name in ("first", "second", "third")]
+        self.assertTrue(first.args_with_defaults is second.args_with_defaults)
+        self.assertTrue(first.arg_names is third.arg_names)
+        # True == 1, but the options are different
+        self.assertFalse(first.args_with_defaults is third.args_with_defaults)
+        self.assertTrue(first.opt_parser.get_option("--count") is
+                        second.opt_parser.get_option("--count"))
+        self.assertEqual(third.opt_parser.get_option("--count").action,
+                         "store_false")
+        self.assertFalse(hasattr(first, "__dict__"))
+        self.assertFalse(hasattr(first.spec, "__dict__"))
+
+    def test_command_lookup(self):
+        """commands can be abbreviated, typos get suggestions"""
+
+        class Lookup(MicroCLI):
+
+            @command()
+            def subtract(self):
+                return "subtract"
+
+            @command()
+            def subscribe(self):
+                return "subscribe"
+
+            @command()
+            def status(self):
+                return "status"
+
+        def run(name):
+            stdout = StringIO()
+            Lookup(["script_name", name], stdout).run()
+            return stdout.getvalue()
+
+        with patch.object(MicroCLI, "exit"):
+            self.assertEqual(run("subt"), "subtract\n")
+            self.assertEqual(run("sta"), "status\n")
+            self.assertEqual(
+                run("sub"),
+                "Ambiguous command 'sub' (could be subscribe, subtract)!\n")
+            self.assertEqual(run("substract"), "".join([
+                "Unrecognized command 'substract' ",
+                "(try the 'help' command for usage info)!\n",
+                "Did you mean 'subtract'?\n"]))
+            self.assertEqual(run("xyz"), "".join([
+                "Unrecognized command 'xyz' ",
+                "(try the 'help' command for usage info)!\n"]))
+        index = Lookup.get_command_index()
+        self.assertEqual(index.suggest("stats"), ["status"])
+        self.assertEqual(index.suggest("hepl"), ["help"])
+        self.assertEqual(index.suggest("sbuscribe"), ["subscribe"])
+        self.assertEqual(index.get_completions("s"),
+                         ["status", "subscribe", "subtract"])
+
+    def test_command_suggestion_index(self):
+        """suggestions only check the names sharing bigrams with the
+        mistyped one, the bigram index is stored next to the manifest"""
+        import microcli
+        from microcli import CommandIndex
+        import random
+        import string
+        generator = random.Random(0)
+        names = set()
+        while len(names) < 5000:
+            names.add("".join(generator.choice(string.ascii_lowercase)
+                              for _ in range(generator.randint(8, 12))))
+        index = CommandIndex(names)
+        name = index.names[1234]
+        typo = name[0] + name[2:]
+        with patch("microcli.get_edit_distance",
+                   wraps=microcli.get_edit_distance) as edit_distance:
+            # the first suggestion checks the names directly, the later
+            # ones build and use the bigram index
+            self.assertEqual(index.suggest(typo), [name])
+            self.assertTrue(edit_distance.call_count > 1000)
+            for _ in range(2):
+                edit_distance.reset_mock()
+                self.assertEqual(index.suggest(typo), [name])
+                self.assertTrue(edit_distance.call_count < 50)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        class Suggested(MicroCLITestCase.T):
+            command_manifest = os.path.join(tmp_dir, "manifest")
+
+        self.addCleanup(Suggested.clear_command_specs)
+        self.assertEqual(Suggested.suggest_commands("f44"), ["f4"])
+        self.assertTrue(os.path.exists(
+            Suggested.command_manifest + ".index"))
+        Suggested.clear_command_specs()
+        with patch.object(CommandIndex, "build_bigram_index") as build:
+            self.assertEqual(Suggested.suggest_commands("f44"), ["f4"])
+            self.assertFalse(build.called)
+
+    def test_completion(self):
+        """command lines are completed from the completion index"""
+        from microcli_complete import complete, load_index
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        index_path = os.path.join(directory, "tool.completion")
+
+        class Completed(ParallelCLI):
+            completion_index_path = index_path
+
+            @command()
+            def shout(self, word, times=1, loud=False):
+                pass
+
+        with patch("sys.exit") as mock_exit:
+            Completed(
+                ["tool", "completion", "--index-only"], StringIO()).run()
+            mock_exit.assert_called_with(0)
+            stdout = StringIO()
+            Completed(["tool", "completion", "--shell", "zsh"], stdout).run()
+            self.assertTrue("compdef _microcli_tool tool" in stdout.getvalue())
+            self.assertTrue(index_path in stdout.getvalue())
+        index = load_index(index_path)
+        for words, expected in [
+                (["tool", "sh"], ["shout"]),
+                (["tool", "--pre"], ["--prefix"]),
+                (["tool", "--prefix", ""], []),
+                (["tool", "--prefix", "x", "e"], ["echo"]),
+                (["tool", "shout", "--"], ["--loud", "--times"]),
+                (["tool", "shout", "--times", ""], []),
+                (["tool", "shout", "--times", "2", "--l"], ["--loud"]),
+                (["tool", "shout", "word", ""], [])]:
+            self.assertEqual(
+                complete(index, words, len(words) - 1), expected)
+        output = subprocess.check_output([
+            sys.executable, "-S",
+            os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "microcli_complete.py"),
+            index_path, "1", "tool", "b"])
+        self.assertEqual(output, b"batch\n")
+
+        # an index which can't be saved is reported on stderr, as the
+        # shell evaluates stdout, and the hook is still printed
+        os.remove(index_path)
+        os.mkdir(index_path)
+        stderr = StringIO()
+        with patch("sys.exit") as mock_exit, patch("sys.stderr", stderr):
+            stdout = StringIO()
+            Completed(["tool", "completion"], stdout).run()
+            mock_exit.assert_called_with(0)
+            self.assertTrue(stdout.getvalue().startswith("_microcli_tool()"))
+            Completed(
+                ["tool", "completion", "--index-only"], StringIO()).run()
+            mock_exit.assert_called_with(1)
+        self.assertTrue(stderr.getvalue().startswith(
+            "Failed to save the completion index: "))
+        self.assertEqual(os.listdir(directory), ["tool.completion"])
+
+    def test_lazy_commands(self):
+        """command groups and plugins are imported when they are run"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with open(os.path.join(directory, "lazy_db_group.py"), "w") as f:
+            f.write("\n".join([
+                "from microcli import MicroCLI, command",
+                "class DatabaseCLI(MicroCLI):",
+                "    def __init__(self, *args, **kwargs):",
+                "        super(DatabaseCLI, self).__init__(",
+                "            *args, **kwargs)",
+                "        self.global_optparser.add_option(",
+                "            '--dry-run', action='store_true',",
+                "            dest='dry_run')",
+                "    @command()",
+                "    def migrate(self, version):",
+                "        return '%s migrate %s%s' % (",
+                "            self.global_options['prefix'], version,",
+                "            ' (dry run)' if self.global_options['dry_run']",
+                "            else '')",
+                ""]))
+        sys.path.insert(0, directory)
+        self.addCleanup(sys.path.remove, directory)
+
+        class FakeEntryPoint(object):
+
+            def __init__(self, name, obj):
+                self.name = name
+                self.obj = obj
+
+            def load(self):
+                return self.obj
+
+        @command()
+        def deploy(cli, target, force=False):
+            return "deploy %s%s" % (target, " --force" if force else "")
+
+        class Tool(ParallelCLI):
+            command_groups = {'db': 'lazy_db_group:DatabaseCLI'}
+            plugin_entry_point_group = 'tool.commands'
+
+        def run(args):
+            stdout = StringIO()
+            Tool(["tool"] + args.split(), stdout).run()
+            return stdout.getvalue()
+
+        with patch("microcli.iter_entry_points",
+                   return_value=[FakeEntryPoint("deploy", deploy)]):
+            with patch("sys.exit") as mock_exit:
+                self.assertEqual(run("echo a"), "a\n")
+                self.assertFalse("lazy_db_group" in sys.modules)
+                self.assertTrue("    db\n    deploy\n" in run("help"))
+                self.assertEqual(
+                    run("--prefix v db --dry-run migrate 2"),
+                    "v migrate 2 (dry run)\n")
+                mock_exit.assert_called_with(0)
+                # options of the group have their defaults
+                self.assertEqual(
+                    run("--prefix v db migrate 2"), "v migrate 2\n")
+                mock_exit.assert_called_with(0)
+                # groups can be stages of pipes
+                self.assertEqual(
+                    run("--prefix v pipe echo 3 then db migrate"),
+                    "v3\nv migrate 3\n")
+                self.assertTrue("lazy_db_group" in sys.modules)
+                self.assertEqual(
+                    run("dep --force prod"), "deploy prod --force\n")
+                mock_exit.assert_called_with(0)
+        del sys.modules["lazy_db_group"]
+
+        # groups and plugins which can't be loaded fail like commands
+        class Broken(ParallelCLI):
+            command_groups = {'db': 'no_such_module:DatabaseCLI'}
+
+        with patch("sys.exit") as mock_exit:
+            cli = Broken("tool db migrate 2".split(), StringIO())
+            cli.run()
+            mock_exit.assert_called_with(1)
+            self.assertTrue(cli.stdout.getvalue().startswith(
+                "Failed to load command 'db'\nError: "))
+        cli = Broken(["tool"], StringIO())
+        self.assertEqual(cli.run_batch(["db migrate 2", "echo a"]),
+                         [(1, "db migrate 2", 1), (2, "echo a", 0)])
+        self.assertTrue(cli.stdout.getvalue().endswith("\na\n"))
+
+    def test_command_help(self):
+        """help <command> only renders that command, the full listing
+        is rendered once per class"""
+        class Help(MicroCLITestCase.T):
+            pass
+        with patch.object(MicroCLI, "exit") as mock_exit:
+            cli = Help(["script_name", "help", "f4"], StringIO())
+            cli.run()
+            mock_exit.assert_called_with(0)
+            self.assertTrue("f4" in cli.stdout.getvalue())
+            self.assertFalse("f8" in cli.stdout.getvalue())
+            # the parsers of the other commands were never built
+            self.assertEqual(cli.command_definitions["f8"]._opt_parser, None)
+            cli = Help(["script_name", "help", "nosuchcommand"], StringIO())
+            cli.run()
+            mock_exit.assert_called_with(1)
+            cli = Help(["script_name", "help"], StringIO())
+            cli.run()
+            listing = cli.stdout.getvalue()
+            # the second listing comes from the cache
+            cli = Help(["script_name", "help"], StringIO())
+            cli.run()
+            self.assertEqual(cli.stdout.getvalue(), listing)
+            self.assertEqual(cli.command_definitions["f8"]._opt_parser, None)
+        Help.clear_command_specs()
+
+    def test_typed_varargs(self):
+        """declared arg types are converted, typed varargs in bulk into
+        arrays, and every bad value is reported"""
+        from array import array
+
+        class Typed(MicroCLI):
+            @command(stream_varargs=True,
+                     arg_types={'count': int, 'number': float})
+            def total(self, count, *number):
+                numbers, = number
+                self.write(type(numbers).__name__)
+                return "%s %s" % (count, sum(numbers) * count)
+
+            @command(arg_types={'names': bytes})
+            def join(self, *names):
+                return b"+".join(names).decode("utf-8")
+
+            @command(arg_types={'values': int})
+            def kinds(self, *values):
+                return " ".join(type(value).__name__ for value in values)
+        with patch("sys.exit") as mock_exit:
+            cli = Typed("script_name total 2 1.5 2.5".split(), StringIO())
+            cli.run()
+            self.assertEqual(cli.stdout.getvalue(), "array\n2 8.0\n")
+            mock_exit.assert_called_with(0)
+            cli = Typed("script_name join a b".split(), StringIO())
+            cli.run()
+            self.assertEqual(cli.stdout.getvalue(), "a+b\n")
+            # without stream_varargs, varargs are plain values
+            with patch("microcli.convert_arg_values",
+                       wraps=convert_arg_values) as convert:
+                cli = Typed("script_name kinds 1 2".split(), StringIO())
+                cli.run()
+                self.assertEqual(convert.call_args[0][2], "list")
+            self.assertEqual(cli.stdout.getvalue(), "int int\n")
+            cli = Typed("script_name total x 1 y 3 z".split(), StringIO())
+            cli.run()
+            self.assertEqual(
+                cli.stdout.getvalue(),
+                "Invalid int value for count: 'x'\n"
+                "Invalid float values for number: 'y', 'z'\n")
+            mock_exit.assert_called_with(1)
+        values = [str(i) for i in range(40000)] + ["bad"]
+        converted, bad_values = convert_arg_values(iter(values), 'int')
+        self.assertEqual(bad_values, ["bad"])
+        self.assertEqual(converted, array(converted.typecode, range(40000)))
+        if sys.version_info >= (3,):
+            import pathlib
+            namespace = {'MicroCLI': MicroCLI, 'command': command,
+                         'pathlib': pathlib}
+            exec(ANNOTATED_CLI_SOURCE, namespace)
+            with patch("sys.exit"):
+                cli = namespace['AnnotatedCLI'](
+                    "script_name scale 0.5 1 2".split(), StringIO())
+                cli.run()
+                self.assertEqual(cli.stdout.getvalue(), "(0.5, (1, 2))\n")
+                # pathlib.Path annotations get Path objects, 'path' strs
+                cli = namespace['AnnotatedCLI'](
+                    "script_name paths a b c".split(), StringIO())
+                cli.run()
+                self.assertEqual(
+                    cli.stdout.getvalue(), "str %s %s\n" % (
+                        (type(pathlib.Path("b")).__name__,) * 2))
+
+    # TODO: test unrecognized command
+    # TODO: test default command
+    # TODO: test kwarg types reflected in help
+    # TODO: test error thrown if kwarg command option value has incorrect type
+
+
+def suite():
+    suite = unittest.TestSuite()
+    loader = unittest.TestLoader()
+    suite.addTest(loader.loadTestsFromTestCase(MicroCLITestCase))
+    return suite
+
+if __name__ == "__main__":
+    unittest.main(
+        defaultTest="suite",
+        testRunner=unittest.TextTestRunner(verbosity=2))